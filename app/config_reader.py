@@ -1,4 +1,5 @@
 import configparser
+import os
 from dataclasses import dataclass
 
 
@@ -8,9 +9,114 @@ class TgBot:
     admin_id: int
 
 
+@dataclass
+class Executor:
+    ghostscript_workers: int
+    batch_workers: int
+    libreoffice_workers: int
+    pypdf_workers: int
+    pillow_workers: int
+
+
+@dataclass
+class LibreOffice:
+    pool_size: int
+    max_jobs: int
+    base_port: int
+
+
+@dataclass
+class Cache:
+    files_dir: str
+    files_max_size: int
+    results_path: str
+    results_ttl: int
+    results_max_entries: int
+    readers_max_entries: int
+
+
+@dataclass
+class Images:
+    workers: int
+    target_dpi: float
+    max_page_size: float
+
+
+@dataclass
+class Compression:
+    shard_workers: int
+    shard_min_size: int
+    shard_min_pages: int
+    adaptive: bool
+
+
+@dataclass
+class Split:
+    workers: int
+
+
+@dataclass
+class Limits:
+    timeout: int
+    memory: int
+    cpu: int
+    ghostscript: int
+
+
+@dataclass
+class Cost:
+    path: str
+    max_seconds: int
+
+
+@dataclass
+class Scheduler:
+    slots: int
+    per_user: int
+    max_queued: int
+
+
+@dataclass
+class Workspace:
+    root: str
+    ram_root: str
+    ram_max_size: int
+    ram_job_size: int
+
+
+@dataclass
+class Workers:
+    remote: bool
+    queue_path: str
+
+
+@dataclass
+class Journal:
+    path: str
+
+
+@dataclass
+class Storage:
+    path: str
+    flush_interval: float
+
+
 @dataclass
 class Config:
     tg_bot: TgBot
+    executor: Executor
+    libreoffice: LibreOffice
+    cache: Cache
+    images: Images
+    split: Split
+    compression: Compression
+    limits: Limits
+    workspace: Workspace
+    scheduler: Scheduler
+    cost: Cost
+    workers: Workers
+    journal: Journal
+    storage: Storage
 
 
 def load_config(path: str):
@@ -18,10 +124,102 @@ def load_config(path: str):
     config.read(path)
 
     tg_bot = config["tg_bot"]
+    cpu_count = os.cpu_count() or 1
+    # 0 keeps starting a fresh libreoffice for every document
+    office_pool_size = config.getint("libreoffice", "pool_size", fallback=0)
 
     return Config(
         tg_bot=TgBot(
             token=tg_bot["token"],
             admin_id=int(tg_bot["admin_id"])
+        ),
+        executor=Executor(
+            ghostscript_workers=config.getint("executor", "ghostscript_workers", fallback=cpu_count),
+            batch_workers=config.getint("executor", "batch_workers", fallback=cpu_count),
+            # cold started libreoffice shares one user profile, so conversions run one at a time without a pool
+            libreoffice_workers=config.getint("executor", "libreoffice_workers", fallback=max(1, office_pool_size)),
+            pypdf_workers=config.getint("executor", "pypdf_workers", fallback=cpu_count),
+            pillow_workers=config.getint("executor", "pillow_workers", fallback=cpu_count)
+        ),
+        libreoffice=LibreOffice(
+            pool_size=office_pool_size,
+            max_jobs=config.getint("libreoffice", "max_jobs", fallback=50),
+            base_port=config.getint("libreoffice", "base_port", fallback=2002)
+        ),
+        cache=Cache(
+            files_dir=config.get("cache", "files_dir", fallback=os.path.join('cache', 'files')),
+            # megabytes
+            files_max_size=config.getint("cache", "files_max_size", fallback=1024),
+            results_path=config.get("cache", "results_path", fallback=os.path.join('cache', 'results.json')),
+            # hours
+            results_ttl=config.getint("cache", "results_ttl", fallback=168),
+            results_max_entries=config.getint("cache", "results_max_entries", fallback=10000),
+            readers_max_entries=config.getint("cache", "readers_max_entries", fallback=32)
+        ),
+        images=Images(
+            # 0 decodes images in the converting thread
+            workers=config.getint("images", "workers", fallback=cpu_count),
+            target_dpi=config.getfloat("images", "target_dpi", fallback=150.0),
+            # inches, long side of A4
+            max_page_size=config.getfloat("images", "max_page_size", fallback=11.69)
+        ),
+        split=Split(
+            # 0 renders separate pages in the splitting thread
+            workers=config.getint("split", "workers", fallback=cpu_count)
+        ),
+        compression=Compression(
+            # below 2 compresses every document with a single ghostscript; sharded documents lose
+            # their forms, page labels and optional content
+            shard_workers=config.getint("compression", "shard_workers", fallback=1),
+            # megabytes; uploads stop at 20, so by default documents are sharded by page count alone
+            shard_min_size=config.getint("compression", "shard_min_size", fallback=0),
+            shard_min_pages=config.getint("compression", "shard_min_pages", fallback=40),
+            # pick the ghostscript level from the document instead of always using /default
+            adaptive=config.getboolean("compression", "adaptive", fallback=True)
+        ),
+        # ghostscript and libreoffice processes, 0 switches a limit off
+        limits=Limits(
+            # seconds of wall-clock time
+            timeout=config.getint("limits", "timeout", fallback=600),
+            # megabytes of address space
+            memory=config.getint("limits", "memory", fallback=4096),
+            # seconds of cpu time
+            cpu=config.getint("limits", "cpu", fallback=600),
+            # ghostscript processes at once for all jobs and batches of the process together
+            ghostscript=config.getint("limits", "ghostscript", fallback=cpu_count)
+        ),
+        workspace=Workspace(
+            root=config.get("workspace", "root", fallback='temp'),
+            # a RAM backed folder such as /dev/shm/pdfile for small jobs, empty keeps everything on disk
+            ram_root=config.get("workspace", "ram_root", fallback=''),
+            # megabytes, for all jobs together and for a single job
+            ram_max_size=config.getint("workspace", "ram_max_size", fallback=256),
+            ram_job_size=config.getint("workspace", "ram_job_size", fallback=32)
+        ),
+        scheduler=Scheduler(
+            # jobs running at once, their tools still share the executor pools
+            slots=config.getint("scheduler", "slots", fallback=cpu_count),
+            per_user=config.getint("scheduler", "per_user", fallback=1),
+            # jobs waiting for a slot, more are turned away as "server busy"
+            max_queued=config.getint("scheduler", "max_queued", fallback=100)
+        ),
+        cost=Cost(
+            path=config.get("cost", "path", fallback=os.path.join('cache', 'costs.json')),
+            # jobs expected to take longer are turned away before they start, 0 accepts everything
+            max_seconds=config.getint("cost", "max_seconds", fallback=600)
+        ),
+        workers=Workers(
+            # jobs go to processes started with `python bot.py --worker`, scheduler slots should match them
+            remote=config.getboolean("workers", "remote", fallback=False),
+            queue_path=config.get("workers", "queue_path", fallback=os.path.join('cache', 'jobs.sqlite'))
+        ),
+        journal=Journal(
+            path=config.get("journal", "path", fallback=os.path.join('cache', 'journal.sqlite'))
+        ),
+        # conversation state of the users
+        storage=Storage(
+            path=config.get("storage", "path", fallback=os.path.join('cache', 'fsm.sqlite')),
+            # seconds between writes, changes made meanwhile are lost with the process
+            flush_interval=config.getfloat("storage", "flush_interval", fallback=1.0)
         )
     )
@@ -3,17 +3,29 @@ import os
 from aiogram import Dispatcher, types
 from aiogram.dispatcher import FSMContext
 
+from app.modules import job_queue
 from app.modules.clean_output import cleaner
 from app.modules.read_messages import txt_dict
+from app.modules.scheduler import scheduler
+from app.tools import supervisor
 
 import logging
 
 logger = logging.getLogger(__name__)
 
 
+# ghostscript or libreoffice still working for the user is stopped, queued jobs are dropped
+async def cancel_jobs(user_id):
+    supervisor.cancel(user_id)
+    scheduler.cancel(user_id)
+    await job_queue.cancel(user_id)
+
+
 async def cmd_start(message: types.Message, state: FSMContext):
+    await cancel_jobs(message.from_user.id)
+    user_data = await state.get_data()
     await state.finish()
-    await cleaner(os.path.join('temp', str(message.from_user.id)))
+    await cleaner(user_data.get('workspace'))
     locale = str(message.from_user.locale) if str(message.from_user.locale) in ['en', 'ru'] else 'en'
     await state.update_data(locale=locale)
     logger.info('User "%s" (%s) with language code "%s" started the bot instance',
@@ -38,9 +50,11 @@ async def cmd_start(message: types.Message, state: FSMContext):
     )
 
 
+# back to the menu, other jobs of the user keep running; cmd_cancel stops them
 async def cmd_idle(message: types.Message, state: FSMContext, headless=True):
+    user_data = await state.get_data()
     await state.finish()
-    await cleaner(os.path.join('temp', str(message.from_user.id)))
+    await cleaner(user_data.get('workspace'))
     locale = str(message.from_user.locale) if str(message.from_user.locale) in ['en', 'ru'] else 'en'
     logger.info('User "%s" (%s) is idle',
                 message.from_user.id, message.from_user.username)
@@ -69,8 +83,15 @@ async def cmd_idle(message: types.Message, state: FSMContext, headless=True):
     )
 
 
+async def cmd_cancel(message: types.Message, state: FSMContext):
+    await cancel_jobs(message.from_user.id)
+    await cmd_idle(message, state)
+
+
 async def cmd_donate(message: types.Message, state: FSMContext):
+    user_data = await state.get_data()
     await state.finish()
+    await cleaner(user_data.get('workspace'))
     locale = str(message.from_user.locale) if str(message.from_user.locale) in ['en', 'ru'] else 'en'
     logger.info('User "%s" (%s) opened donate page',
                 message.from_user.id, message.from_user.username)
@@ -89,7 +110,9 @@ async def cmd_donate(message: types.Message, state: FSMContext):
 
 
 async def cmd_help(message: types.Message, state: FSMContext):
+    user_data = await state.get_data()
     await state.finish()
+    await cleaner(user_data.get('workspace'))
     locale = str(message.from_user.locale) if str(message.from_user.locale) in ['en', 'ru'] else 'en'
     logger.info('User "%s" (%s) entered unknown text: %s',
                 message.from_user.id, message.from_user.username, message.text)
@@ -99,8 +122,8 @@ async def cmd_help(message: types.Message, state: FSMContext):
 
 def register_handlers_common(dp: Dispatcher):
     dp.register_message_handler(cmd_start, commands="start", state="*")
-    dp.register_message_handler(cmd_idle, commands="idle", state="*")
-    dp.register_message_handler(cmd_idle, lambda message: message.text in txt_dict['cancel_text'].values(), state="*")
+    dp.register_message_handler(cmd_cancel, commands="idle", state="*")
+    dp.register_message_handler(cmd_cancel, lambda message: message.text in txt_dict['cancel_text'].values(), state="*")
     dp.register_message_handler(cmd_donate, commands="donate", state="*")
     dp.register_message_handler(cmd_donate, lambda message: message.text in txt_dict['donate_text'].values())
     dp.register_message_handler(cmd_help, commands="help", state="*")
@@ -1,4 +1,3 @@
-import asyncio
 import os
 
 from aiogram import Dispatcher, types
@@ -8,7 +7,14 @@ from aiogram.types import ContentType
 from unidecode import unidecode
 
 from app.handlers.common import cmd_idle
-from app.tools import tools
+from app.modules.cost_estimator import answer_too_heavy
+from app.modules.file_cache import file_cache
+from app.modules.fsm_storage import append_data
+from app.modules.result_cache import answer_cached, answer_result, fingerprint
+from app.modules.scheduler import JobRejected, run_job
+from app.modules.upload_aggregator import UploadAggregator, batch_key
+from app.modules.workspace import start_workspace, workspaces
+from app.tools import supervisor
 from app.tools.tools import check_invalid_format
 import logging
 
@@ -16,23 +22,20 @@ from app.modules.read_messages import txt_dict, errors_dict
 
 logger = logging.getLogger(__name__)
 
+compress_text = list(txt_dict['compress_text'].values()) + list(txt_dict['compress_images_text'].values())
+
 
 class UserControlCompress(StatesGroup):
     compress_file = State()
 
 
 async def compress_activate(message: types.Message, state: FSMContext):
-    global added_files, lst
-    added_files = 0
-    lst = []
-
     locale = str(message.from_user.locale) if str(message.from_user.locale) in ['en', 'ru'] else 'en'
     logger.info('User "%s" (%s) chose to compress PDF',
                 message.from_user.id, message.from_user.username)
-    await state.update_data(locale=locale)
-
     reply_keyboard = [[txt_dict['compress_text'][locale],
-                       txt_dict['cancel_text'][locale]]]
+                       txt_dict['compress_images_text'][locale]],
+                      [txt_dict['cancel_text'][locale]]]
 
     markup = types.ReplyKeyboardMarkup(reply_keyboard,
                                        resize_keyboard=True,
@@ -41,7 +44,8 @@ async def compress_activate(message: types.Message, state: FSMContext):
     await message.answer(txt_dict['compress_input_text'][locale],
                          reply_markup=markup)
 
-    await state.update_data(list_of_files=list(), function='compress')
+    await state.update_data(locale=locale, list_of_files=list(), file_unique_ids=list(), function='compress',
+                            workspace=await start_workspace(state, message.from_user.id))
 
     await UserControlCompress.compress_file.set()
 
@@ -85,52 +89,65 @@ async def handle_files(message: types.Message, state: FSMContext):
         logger.error('User "%s" (%s) raised unsupported file format error',
                      message.from_user.id, message.from_user.username)
         return None
-    output_folder = os.path.join('temp', str(message.from_user.id))
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder, exist_ok=True)
-    file_path = os.path.join(output_folder, file_name)
+    file_path = workspaces.file_path(user_data['workspace'], file_name, file_size)
+
+    with aggregator.collect(batch_key(message), message, state):
+        await file_cache.fetch(file, file_path)
+        if await answer_too_heavy(message, function, file_path, locale):
+            return None
 
-    await file.download(destination_file=file_path)
+        await append_data(state, list_of_files=file_path, file_unique_ids=file['file_unique_id'])
 
+
+# show the queue once per album or batch of forwarded files
+async def send_queue(message: types.Message, state: FSMContext):
     user_data = await state.get_data()
-    list_of_files = user_data['list_of_files']
-    list_of_files.append(file_path)
-    await state.update_data(list_of_files=list_of_files)
+    list_of_files = user_data.get('list_of_files')
+    if not list_of_files:
+        return None
+    locale = user_data['locale']
+    printed_list = ['{}. {}'.format(n + 1, os.path.basename(f)) for n, f in enumerate(list_of_files)]
+    await message.answer(txt_dict['compress_queue_text'][locale].format('\n'.join(printed_list)))
 
-    global added_files
-    await asyncio.sleep(1)
 
-    # this crutch helps with mutiple file processing:
-    # https://stackoverflow.com/questions/70420866/handle-files-in-media-group-using-aiogram
-    handler_tasks = [task for task in asyncio.all_tasks() if 'Handler' in str(task.get_coro())]
-    lst.append(len(handler_tasks))
-    max_value = max(lst)
-    if len(list_of_files) == max_value + added_files:
-        printed_list = ['{}. {}'.format(n + 1, os.path.basename(f)) for n, f in enumerate(list_of_files)]
-        await message.answer(txt_dict['compress_queue_text'][locale].format('\n'.join(printed_list)))
-        lst.clear()
-        added_files += max_value
+aggregator = UploadAggregator(send_queue)
 
 
 async def compress_file(message: types.Message, state: FSMContext):
     user_data = await state.get_data()
     locale = user_data['locale']
     files = user_data['list_of_files']
-    output_folder: str = os.path.join('temp', str(message.from_user.id))
+    output_folder = workspaces.output_folder(user_data['workspace'])
+    supervisor.owner.set(message.from_user.id)
+
+    # scans are usually better off with their images recompressed than with a full re-render
+    engine = 'images' if message.text in txt_dict['compress_images_text'].values() else 'ghostscript'
 
     if len(files) >= 1:
-        try:
-            output_path = tools.compress(files, output_folder)
-            await types.ChatActions.upload_document()
-            await message.answer_document(open(output_path, 'rb'))
-            logger.info('User "%s" (%s) compressed file(s) successfully',
-                        message.from_user.id, message.from_user.username)
-            await cmd_idle(message, state, headless=False)
-        except Exception as e:
-            await message.answer(errors_dict['func_failed'][locale])
-            logger.error('User "%s" (%s) raised error %s while compressing',
-                         message.from_user.id, message.from_user.username, e)
-            await cmd_idle(message, state, headless=True)
+        # the workspace stays until the answer is sent, even when the job is cancelled meanwhile
+        with workspaces.use(user_data['workspace']):
+            try:
+                key = fingerprint('compress', user_data['file_unique_ids'], files, engine=engine)
+                if not await answer_cached(message, key):
+                    output_path = await run_job(message, 'compress', files, output_folder, engine=engine)
+                    await answer_result(message, key, output_path)
+                logger.info('User "%s" (%s) compressed file(s) successfully',
+                            message.from_user.id, message.from_user.username)
+                await cmd_idle(message, state, headless=False)
+            except supervisor.ToolCancelled:
+                # the user pressed cancel, the idle menu is already there
+                logger.info('User "%s" (%s) cancelled compressing',
+                            message.from_user.id, message.from_user.username)
+            except JobRejected as e:
+                await message.answer(errors_dict[e.error][locale])
+                logger.warning('User "%s" (%s) was turned away while compressing: %s',
+                               message.from_user.id, message.from_user.username, e)
+                await cmd_idle(message, state, headless=True)
+            except Exception as e:
+                await message.answer(errors_dict['func_failed'][locale])
+                logger.error('User "%s" (%s) raised error %s while compressing',
+                             message.from_user.id, message.from_user.username, e)
+                await cmd_idle(message, state, headless=True)
     else:
         await message.answer(errors_dict['no_files'][locale])
         return None
@@ -140,9 +157,9 @@ def register_handlers_compress(dp: Dispatcher):
     dp.register_message_handler(compress_activate,
                                 lambda message: message.text in txt_dict['compress_pdf_text'].values(), state="*")
     dp.register_message_handler(handle_files, content_types=ContentType.DOCUMENT, state=UserControlCompress.compress_file)
-    dp.register_message_handler(compress_file, lambda message: message.text in txt_dict['compress_text'].values(),
+    dp.register_message_handler(compress_file, lambda message: message.text in compress_text,
                                 state=UserControlCompress.compress_file)
-    dp.register_message_handler(handle_errors, lambda message: message.text not in txt_dict['compress_text'].values(),
+    dp.register_message_handler(handle_errors, lambda message: message.text not in compress_text,
                                 state=UserControlCompress.compress_file)
     dp.register_message_handler(handle_errors, content_types=ContentType.ANY,
                                 state=UserControlCompress.compress_file)
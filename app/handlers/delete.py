@@ -1,5 +1,4 @@
 import os
-import re
 
 from aiogram import Dispatcher, types
 from aiogram.dispatcher import FSMContext
@@ -8,8 +7,15 @@ from aiogram.types import ContentType
 from unidecode import unidecode
 
 from app.handlers.common import cmd_idle
-from app.tools import tools
-from app.tools.tools import check_invalid_format, count_pages, create_range
+from app.modules.cost_estimator import answer_too_heavy
+from app.modules.executor import run_tool, submit_tool
+from app.modules.file_cache import file_cache
+from app.modules.result_cache import answer_cached, answer_result, fingerprint
+from app.modules.scheduler import JobRejected, run_job
+from app.modules.workspace import start_workspace, workspaces
+from app.tools import supervisor
+from app.tools.page_range import PageSelection
+from app.tools.tools import check_invalid_format
 import logging
 
 from app.modules.read_messages import txt_dict, errors_dict
@@ -26,8 +32,6 @@ async def delete_activate(message: types.Message, state: FSMContext):
     locale = str(message.from_user.locale) if str(message.from_user.locale) in ['en', 'ru'] else 'en'
     logger.info('User "%s" (%s) chose to delete pages from PDF',
                 message.from_user.id, message.from_user.username)
-    await state.update_data(locale=locale)
-
     reply_keyboard = [[txt_dict['cancel_text'][locale]]]
 
     markup = types.ReplyKeyboardMarkup(reply_keyboard,
@@ -37,7 +41,8 @@ async def delete_activate(message: types.Message, state: FSMContext):
     await message.answer(txt_dict['delete_input_text'][locale],
                          reply_markup=markup)
 
-    await state.update_data(file_path=str, function='delete')
+    await state.update_data(locale=locale, file_path=None, function='delete',
+                            workspace=await start_workspace(state, message.from_user.id))
 
     await UserControlDelete.handle_file.set()
 
@@ -82,16 +87,14 @@ async def handle_single_file(message: types.Message, state: FSMContext):
         logger.error('User "%s" (%s) raised unsupported file format error',
                      message.from_user.id, message.from_user.username)
         return None
-    output_folder = os.path.join('temp', str(message.from_user.id))
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder, exist_ok=True)
-    file_path = os.path.join(output_folder, file_name)
-
-    await file.download(destination_file=file_path)
-    await state.update_data(file_path=file_path)
+    file_path = workspaces.file_path(user_data['workspace'], file_name, file_size)
 
-    pages = count_pages(file_path)
-    await state.update_data(pages=pages)
+    await file_cache.fetch(file, file_path)
+    if await answer_too_heavy(message, function, file_path, locale):
+        return None
+    pages = await run_tool('count_pages', file_path)
+    await state.update_data(file_path=file_path, file_unique_id=file['file_unique_id'], pages=pages)
+    submit_tool('preload', file_path)
 
     await message.answer(txt_dict['delete_queue_text'][locale].format(os.path.basename(file_path), pages))
     await message.answer(txt_dict['available_range_text'][locale],
@@ -105,55 +108,57 @@ async def delete_pages(message: types.Message, state: FSMContext):
     locale = user_data['locale']
     pages = user_data['pages']
 
-    if re.match('^\s*\d+[-\d+]*\s*(,\s*\d+[-\d+]*\s*)*\s*$', message.text):
-        delete_range_string = message.text
-        custom_range = create_range(message.text, pages)
-        if any((i > pages for i in custom_range) or any(i <= 0 for i in custom_range)):
-            logger.error('User "%s" (%s) defined unavailable range. Range: %s, number of pages: %s',
-                         message.from_user.id, message.from_user.username, custom_range, pages)
-            custom_range = [i for i in custom_range if (i <= pages) and (i > 0)]
-            if len(custom_range) < 1:
-                logger.error('User "%s" (%s) has range with zero length. Range: %s, number of pages: %s',
-                             message.from_user.id, message.from_user.username, message.text, pages)
-                await message.answer(errors_dict['unsupported_pattern'][locale])
-                await message.answer(txt_dict['available_range_text'][locale],
-                                     parse_mode='MarkdownV2')
-                return None
-            else:
-                await message.answer(errors_dict['unsupported_range_exceed'][locale])
-                delete_range = custom_range
-        else:
-            if len(custom_range) < 1:
-                logger.error('User "%s" (%s) has range with zero length. Range: %s, number of pages: %s',
-                             message.from_user.id, message.from_user.username, message.text, pages)
-                await message.answer(errors_dict['unsupported_pattern'][locale])
-                await message.answer(txt_dict['available_range_text'][locale],
-                                     parse_mode='MarkdownV2')
-            delete_range = custom_range
-
-    else:
+    try:
+        selection = PageSelection.parse(message.text, pages)
+    except ValueError:
         logger.error('User "%s" (%s) raised unavailable pattern error. Message: %s',
                      message.from_user.id, message.from_user.username, message.text)
         await message.answer(errors_dict['unsupported_pattern'][locale])
         await message.answer(txt_dict['available_range_text'][locale],
                              parse_mode='MarkdownV2')
         return None
+    if len(selection) < 1:
+        logger.error('User "%s" (%s) has range with zero length. Range: %s, number of pages: %s',
+                     message.from_user.id, message.from_user.username, message.text, pages)
+        await message.answer(errors_dict['unsupported_pattern'][locale])
+        await message.answer(txt_dict['available_range_text'][locale],
+                             parse_mode='MarkdownV2')
+        return None
+    if selection.truncated:
+        logger.error('User "%s" (%s) defined unavailable range. Range: %s, number of pages: %s',
+                     message.from_user.id, message.from_user.username, message.text, pages)
+        await message.answer(errors_dict['unsupported_range_exceed'][locale])
+    delete_range_string = message.text
+    delete_range = selection.intervals
 
     file = user_data['file_path']
-    output_folder: str = os.path.join('temp', str(message.from_user.id))
-
-    try:
-        output_path = tools.delete(file, delete_range_string, delete_range, output_folder)
-        await types.ChatActions.upload_document()
-        await message.answer_document(open(output_path, 'rb'))
-        logger.info('User "%s" (%s) deleted pages from file successfully',
-                    message.from_user.id, message.from_user.username)
-        await cmd_idle(message, state, headless=False)
-    except Exception as e:
-        await message.answer(errors_dict['func_failed'][locale])
-        logger.error('User "%s" (%s) raised error %s while deleting pages',
-                     message.from_user.id, message.from_user.username, e)
-        await cmd_idle(message, state, headless=True)
+    output_folder = workspaces.output_folder(user_data['workspace'])
+    supervisor.owner.set(message.from_user.id)
+
+    # the workspace stays until the answer is sent, even when the job is cancelled meanwhile
+    with workspaces.use(user_data['workspace']):
+        try:
+            key = fingerprint('delete', [user_data['file_unique_id']], [file], delete_range=delete_range)
+            if not await answer_cached(message, key):
+                output_path = await run_job(message, 'delete', file, delete_range_string, delete_range, output_folder)
+                await answer_result(message, key, output_path)
+            logger.info('User "%s" (%s) deleted pages from file successfully',
+                        message.from_user.id, message.from_user.username)
+            await cmd_idle(message, state, headless=False)
+        except supervisor.ToolCancelled:
+            # the user pressed cancel, the idle menu is already there
+            logger.info('User "%s" (%s) cancelled deleting pages',
+                        message.from_user.id, message.from_user.username)
+        except JobRejected as e:
+            await message.answer(errors_dict[e.error][locale])
+            logger.warning('User "%s" (%s) was turned away while deleting pages: %s',
+                           message.from_user.id, message.from_user.username, e)
+            await cmd_idle(message, state, headless=True)
+        except Exception as e:
+            await message.answer(errors_dict['func_failed'][locale])
+            logger.error('User "%s" (%s) raised error %s while deleting pages',
+                         message.from_user.id, message.from_user.username, e)
+            await cmd_idle(message, state, headless=True)
 
 
 def register_handlers_delete(dp: Dispatcher):
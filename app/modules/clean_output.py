@@ -1,6 +1,7 @@
-# clean output folder
-import shutil
+# release the workspace of a job, its files are removed in the background once nothing uses them
+from app.modules.workspace import workspaces
 
 
-async def cleaner(output_folder):
-    shutil.rmtree(output_folder, ignore_errors=True)
+async def cleaner(workspace):
+    if workspace:
+        workspaces.release(workspace)
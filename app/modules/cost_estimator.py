@@ -0,0 +1,129 @@
+# expected seconds of a job: a fixed start cost plus its work units times a rate per operation,
+# the rates follow recorded job timings and are kept between restarts, saved together every
+# save_interval seconds by an executor thread
+import asyncio
+import json
+import logging
+import os
+from collections import OrderedDict
+
+from app.modules.executor import run_tool
+from app.modules.read_messages import errors_dict
+
+logger = logging.getLogger(__name__)
+
+# seconds per job and per work unit before any timing is recorded
+overheads = {'compress': 1.0, 'merge': 0.2, 'split': 0.2, 'delete': 0.2, 'doc2pdf': 3.0, 'ppt2pdf': 3.0,
+             'img2pdf': 0.2}
+default_rates = {'compress': 0.1, 'merge': 0.005, 'split': 0.01, 'delete': 0.005, 'doc2pdf': 0.3,
+                 'ppt2pdf': 0.3, 'img2pdf': 0.05}
+# weight of the newest timing in a rate
+smoothing = 0.2
+
+
+class CostEstimator:
+    def __init__(self, path=os.path.join('cache', 'costs.json'), max_seconds=600, max_probes=1000,
+                 save_interval=5.0):
+        self.path = path
+        self.max_seconds = max_seconds
+        self.max_probes = max_probes
+        self.save_interval = save_interval
+        self.rates = None
+        self.dirty = False
+        self.saver = None
+        self.save_lock = None
+        # (operation, path, size) -> work units, files are probed once for the upload and the job
+        self.probes = OrderedDict()
+
+    def load(self):
+        self.rates = dict(default_rates)
+        try:
+            with open(self.path, 'r', encoding='utf8') as file:
+                stored = json.load(file)
+        except (FileNotFoundError, ValueError):
+            stored = {}
+        self.rates.update((operation, rate) for operation, rate in stored.items() if operation in self.rates)
+
+    def save(self, rates):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w', encoding='utf8') as file:
+            json.dump(rates, file)
+        os.replace(temp_path, self.path)
+
+    def changed(self):
+        self.dirty = True
+        if self.saver is None or self.saver.done():
+            self.saver = asyncio.get_running_loop().create_task(self.save_later())
+
+    # timings recorded while a save is written are saved by the next round
+    async def save_later(self):
+        while self.dirty:
+            await asyncio.sleep(self.save_interval)
+            await self.flush()
+
+    async def flush(self):
+        if self.save_lock is None:
+            self.save_lock = asyncio.Lock()
+        async with self.save_lock:
+            if not self.dirty:
+                return
+            self.dirty = False
+            await asyncio.get_running_loop().run_in_executor(None, self.save, dict(self.rates))
+
+    # a save being written is waited for, so the last one wins
+    async def close(self):
+        await self.flush()
+        if self.saver is not None:
+            self.saver.cancel()
+
+    async def units(self, operation, files):
+        files = [files] if isinstance(files, str) else files
+        units = 0
+        for file_path in files:
+            key = (operation, file_path, os.path.getsize(file_path))
+            if key not in self.probes:
+                self.probes[key] = await run_tool('work_units', operation, file_path)
+                while len(self.probes) > self.max_probes:
+                    self.probes.popitem(last=False)
+            units += self.probes[key]
+        return units
+
+    def estimate(self, operation, units):
+        if self.rates is None:
+            self.load()
+        return overheads[operation] + self.rates[operation] * units
+
+    def too_heavy(self, seconds):
+        return self.max_seconds > 0 and seconds > self.max_seconds
+
+    def record(self, operation, units, seconds):
+        if self.rates is None:
+            self.load()
+        if units <= 0:
+            return
+        rate = max(0.0, seconds - overheads[operation]) / units
+        self.rates[operation] += smoothing * (rate - self.rates[operation])
+        logger.info('%s took %.1f s for %.1f units, %.4f s per unit now', operation, seconds, units,
+                    self.rates[operation])
+        self.changed()
+
+
+cost_estimator = CostEstimator()
+
+
+def configure(path, max_seconds):
+    cost_estimator.path = path
+    cost_estimator.max_seconds = max_seconds
+    cost_estimator.load()
+
+
+# turn an uploaded file away when the job could not be done in time even with nothing else in it
+async def answer_too_heavy(message, operation, file_path, locale):
+    seconds = cost_estimator.estimate(operation, await cost_estimator.units(operation, file_path))
+    if not cost_estimator.too_heavy(seconds):
+        return False
+    await message.answer(os.path.basename(file_path) + errors_dict['too_heavy'][locale])
+    logger.error('User "%s" (%s) uploaded a file that would take %.0f s to process',
+                 message.from_user.id, message.from_user.username, seconds)
+    return True
@@ -0,0 +1,82 @@
+# run app.tools.tools operations off the event loop
+import asyncio
+import contextvars
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from app.modules import job_queue
+from app.tools import cost_probe, supervisor, tools
+
+logger = logging.getLogger(__name__)
+
+# every tool is bound to the kind of work it does, each kind gets its own bounded pool
+operations = {'compress': (tools.compress, 'ghostscript'),
+              'merge': (tools.merge, 'pypdf'),
+              'split': (tools.split, 'pypdf'),
+              'delete': (tools.delete, 'pypdf'),
+              'count_pages': (tools.count_pages, 'pypdf'),
+              'preload': (tools.preload, 'pypdf'),
+              'work_units': (cost_probe.work_units, 'pypdf'),
+              'doc2pdf': (tools.doc2pdf, 'libreoffice'),
+              'ppt2pdf': (tools.ppt2pdf, 'libreoffice'),
+              'img2pdf': (tools.img2pdf, 'pillow')}
+
+# operations the workers take over when the job queue is on, quick probes stay in the bot
+remote_operations = {'compress', 'merge', 'split', 'delete', 'doc2pdf', 'ppt2pdf', 'img2pdf'}
+# operations that only warm caches of this process for a later remote operation, so they are
+# skipped when the workers do the job
+warmup_operations = {'preload'}
+
+workers = {'ghostscript': 2, 'libreoffice': 1, 'pypdf': 2, 'pillow': 2}
+pools = {}
+
+
+# set worker counts per operation type, pools are (re)created lazily
+def configure(executor_config):
+    for operation_type in workers:
+        workers[operation_type] = max(1, getattr(executor_config, '{}_workers'.format(operation_type)))
+    tools.batch_workers = max(1, executor_config.batch_workers)
+    shutdown(wait=False)
+    logger.info('Executor is configured with workers: %s', workers)
+
+
+def get_pool(operation_type):
+    if operation_type not in pools:
+        pools[operation_type] = ThreadPoolExecutor(max_workers=workers[operation_type],
+                                                   thread_name_prefix=operation_type)
+    return pools[operation_type]
+
+
+# run a tool in its pool and wait for the result without blocking other updates
+async def run_tool(operation, *args, **kwargs):
+    if job_queue.queue is not None and operation in remote_operations:
+        return await job_queue.queue.run(operation, args, kwargs, supervisor.owner.get())
+    function, operation_type = operations[operation]
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    call = functools.partial(context.run, supervisor.as_job, function, *args, **kwargs)
+    return await loop.run_in_executor(get_pool(operation_type), call)
+
+
+# start a tool in the background without waiting for it, failures are only logged
+# returns None for a warmup the workers would not profit from
+def submit_tool(operation, *args, **kwargs):
+    if job_queue.queue is not None and operation in warmup_operations:
+        return None
+    function, operation_type = operations[operation]
+    job = get_pool(operation_type).submit(contextvars.copy_context().run, supervisor.as_job, function, *args,
+                                          **kwargs)
+    job.add_done_callback(functools.partial(log_failure, operation))
+    return job
+
+
+def log_failure(operation, job):
+    if not job.cancelled() and job.exception() is not None:
+        logger.error('Background %s raised error %s', operation, job.exception())
+
+
+def shutdown(wait=True):
+    for pool in pools.values():
+        pool.shutdown(wait=wait)
+    pools.clear()
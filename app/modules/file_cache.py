@@ -0,0 +1,110 @@
+# content-addressed cache of downloaded telegram files keyed by file_unique_id
+import asyncio
+import logging
+import os
+import shutil
+import uuid
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class FileCache:
+    def __init__(self, root=os.path.join('cache', 'files'), max_bytes=1024 * 1024 * 1024):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.entries = None
+        self.total_bytes = 0
+        self.locks = {}
+        # keys fetches are working with -> number of fetches, their files are not evicted
+        self.users = {}
+
+    # read what is already on disk, least recently used first
+    def load(self):
+        os.makedirs(self.root, exist_ok=True)
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        files = []
+        for entry in os.scandir(self.root):
+            if not entry.is_file():
+                continue
+            if '.part-' in entry.name:
+                os.remove(entry.path)
+                continue
+            stat = entry.stat()
+            files.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, key, size in sorted(files):
+            self.entries[key] = size
+            self.total_bytes += size
+        self.evict()
+
+    def evict(self):
+        for key in list(self.entries):
+            if self.total_bytes <= self.max_bytes or len(self.entries) <= 1:
+                break
+            # a file still being linked or copied to a workspace stays
+            if key in self.users:
+                continue
+            size = self.entries.pop(key)
+            self.total_bytes -= size
+            try:
+                os.remove(os.path.join(self.root, key))
+            except FileNotFoundError:
+                pass
+            logger.info('File "%s" (%d bytes) is evicted from cache', key, size)
+
+    # place the file at destination, downloading it only if it is not cached yet
+    async def fetch(self, file, destination):
+        if self.entries is None:
+            self.load()
+        key = file['file_unique_id']
+        cached_path = os.path.join(self.root, key)
+        self.users[key] = self.users.get(key, 0) + 1
+        lock = self.locks.setdefault(key, asyncio.Lock())
+        try:
+            async with lock:
+                if key in self.entries and os.path.isfile(cached_path):
+                    self.entries.move_to_end(key)
+                    os.utime(cached_path)
+                    logger.info('File "%s" is taken from cache', key)
+                else:
+                    part_path = '{}.part-{}'.format(cached_path, uuid.uuid4().hex)
+                    try:
+                        await file.download(destination_file=part_path)
+                        os.replace(part_path, cached_path)
+                    finally:
+                        if os.path.exists(part_path):
+                            os.remove(part_path)
+                    size = os.path.getsize(cached_path)
+                    self.total_bytes += size - self.entries.pop(key, 0)
+                    self.entries[key] = size
+                    self.evict()
+                # a copy to another filesystem, like a RAM workspace, is not made on the event loop
+                await asyncio.get_running_loop().run_in_executor(None, link, cached_path, destination)
+        finally:
+            # the lock goes with the last fetch of the key, the ones waiting for it keep it
+            self.users[key] -= 1
+            if not self.users[key]:
+                del self.users[key]
+                self.locks.pop(key, None)
+        return destination
+
+
+# hard links survive eviction of the cache entry; across filesystems the file is copied, as a
+# symlink would keep reading from the cache and break once the entry is evicted
+def link(source, destination):
+    if os.path.lexists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+file_cache = FileCache()
+
+
+def configure(root, max_bytes):
+    file_cache.root = root
+    file_cache.max_bytes = max_bytes
+    file_cache.load()
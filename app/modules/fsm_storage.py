@@ -0,0 +1,177 @@
+# conversation state kept in sqlite, so it survives restarts: reads are served from memory,
+# changes are written in batches every flush_interval seconds by a background thread
+import asyncio
+import copy
+import json
+import os
+import sqlite3
+import threading
+
+from aiogram.dispatcher.storage import BaseStorage
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS fsm (
+    chat TEXT NOT NULL,
+    user TEXT NOT NULL,
+    record TEXT NOT NULL,
+    PRIMARY KEY (chat, user)
+)'''
+
+
+def empty_record():
+    return {'state': None, 'data': {}, 'bucket': {}}
+
+
+class SqliteStorage(BaseStorage):
+    """FSM storage of one bot process in a sqlite file.
+
+    Unlike MemoryStorage, get_data returns a shallow copy: lists in it must not be changed in
+    place, append_data adds to them without copying what is there already. Changes of the last
+    flush_interval seconds are lost when the process is killed.
+    """
+
+    def __init__(self, path=os.path.join('cache', 'fsm.sqlite'), flush_interval=1.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.records = {}
+        self.dirty = set()
+        self.flusher = None
+        self.flush_lock = asyncio.Lock()
+        self.local = threading.local()
+
+    # the event loop reads and the flushing thread writes, each with its own connection
+    def connection(self):
+        if getattr(self.local, 'connection', None) is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            connection = sqlite3.connect(self.path, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(SCHEMA)
+            self.local.connection = connection
+        return self.local.connection
+
+    def record(self, chat, user):
+        chat, user = map(str, self.check_address(chat=chat, user=user))
+        key = chat, user
+        if key not in self.records:
+            row = self.connection().execute('SELECT record FROM fsm WHERE chat = ? AND user = ?', key).fetchone()
+            self.records[key] = json.loads(row[0]) if row else empty_record()
+        return key, self.records[key]
+
+    def changed(self, key):
+        self.dirty.add(key)
+        if self.flusher is None or self.flusher.done():
+            self.flusher = asyncio.get_running_loop().create_task(self.flush_later())
+
+    # changes made while a flush is written see this task still running, the next round takes them
+    async def flush_later(self):
+        while self.dirty:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        async with self.flush_lock:
+            if not self.dirty:
+                return
+            rows = []
+            for key in self.dirty:
+                record = self.records.get(key, empty_record())
+                if record == empty_record():
+                    # users without state are not kept in memory, most of them just went idle
+                    self.records.pop(key, None)
+                    rows.append((key, None))
+                else:
+                    rows.append((key, json.dumps(record)))
+            self.dirty.clear()
+            await asyncio.get_running_loop().run_in_executor(None, self.write, rows)
+
+    def write(self, rows):
+        connection = self.connection()
+        connection.execute('BEGIN')
+        try:
+            for (chat, user), record in rows:
+                if record is None:
+                    connection.execute('DELETE FROM fsm WHERE chat = ? AND user = ?', (chat, user))
+                else:
+                    connection.execute('INSERT OR REPLACE INTO fsm (chat, user, record) VALUES (?, ?, ?)',
+                                       (chat, user, record))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+    # values of a data key over all stored users, read before polling starts
+    def values(self, name):
+        records = [json.loads(row[0]) for row in self.connection().execute('SELECT record FROM fsm')]
+        return [record['data'][name] for record in records if name in record['data']]
+
+    # a flush being written is waited for, so the last one wins
+    async def close(self):
+        await self.flush()
+        if self.flusher is not None:
+            self.flusher.cancel()
+
+    async def wait_closed(self):
+        pass
+
+    async def get_state(self, *, chat=None, user=None, default=None):
+        _, record = self.record(chat, user)
+        return record['state'] if record['state'] is not None else self.resolve_state(default)
+
+    async def get_data(self, *, chat=None, user=None, default=None):
+        _, record = self.record(chat, user)
+        return dict(record['data'])
+
+    async def update_data(self, *, chat=None, user=None, data=None, **kwargs):
+        key, record = self.record(chat, user)
+        record['data'].update(data or {}, **kwargs)
+        self.changed(key)
+
+    # adds one item to each of the named lists
+    async def append_data(self, *, chat=None, user=None, **items):
+        key, record = self.record(chat, user)
+        for name, item in items.items():
+            record['data'].setdefault(name, []).append(item)
+        self.changed(key)
+
+    async def set_state(self, *, chat=None, user=None, state=None):
+        key, record = self.record(chat, user)
+        record['state'] = self.resolve_state(state)
+        self.changed(key)
+
+    async def set_data(self, *, chat=None, user=None, data=None):
+        key, record = self.record(chat, user)
+        record['data'] = copy.deepcopy(data or {})
+        self.changed(key)
+
+    async def reset_state(self, *, chat=None, user=None, with_data=True):
+        key, record = self.record(chat, user)
+        record['state'] = None
+        if with_data:
+            record['data'] = {}
+        self.changed(key)
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *, chat=None, user=None, default=None):
+        _, record = self.record(chat, user)
+        return copy.deepcopy(record['bucket'])
+
+    async def set_bucket(self, *, chat=None, user=None, bucket=None):
+        key, record = self.record(chat, user)
+        record['bucket'] = copy.deepcopy(bucket or {})
+        self.changed(key)
+
+    async def update_bucket(self, *, chat=None, user=None, bucket=None, **kwargs):
+        key, record = self.record(chat, user)
+        record['bucket'].update(bucket or {}, **kwargs)
+        self.changed(key)
+
+
+# appends items to lists in the state of the user, without the copies of get_data and update_data
+async def append_data(state, **items):
+    if isinstance(state.storage, SqliteStorage):
+        await state.storage.append_data(chat=state.chat, user=state.user, **items)
+        return
+    data = await state.get_data()
+    await state.update_data({name: data.get(name, []) + [item] for name, item in items.items()})
@@ -0,0 +1,126 @@
+# journal of jobs kept in sqlite: what was asked, how far it got and where the output is, so a
+# restarted bot can finish or resend what the previous run left (see app.modules.recovery)
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# finished entries are kept this many seconds
+keep_finished = 24 * 3600
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS journal (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id INTEGER NOT NULL,
+    locale TEXT NOT NULL,
+    operation TEXT NOT NULL,
+    arguments TEXT NOT NULL,
+    stage TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    output TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+)'''
+
+
+class JournalEntry:
+    def __init__(self, entry_id, chat_id, locale, operation, args, kwargs, stage, attempts, output):
+        self.id = entry_id
+        self.chat_id = chat_id
+        self.locale = locale
+        self.operation = operation
+        self.args = args
+        self.kwargs = kwargs
+        self.stage = stage
+        self.attempts = attempts
+        self.output = output
+
+    # input files of the job, the first argument of every operation
+    def inputs(self):
+        return [self.args[0]] if isinstance(self.args[0], str) else list(self.args[0])
+
+
+class JobJournal:
+    """Entries go queued -> running -> done -> delivered, or end up failed or cancelled."""
+
+    def __init__(self, path=os.path.join('cache', 'journal.sqlite')):
+        self.path = path
+        self.db = None
+        # statements run one after another in this thread, the only one using the connection
+        self.thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix='journal')
+
+    def connection(self):
+        if self.db is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self.db = sqlite3.connect(self.path, isolation_level=None)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            # a commit may get lost with the machine, never with the process
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.execute(SCHEMA)
+        return self.db
+
+    def execute(self, statement, parameters):
+        cursor = self.connection().execute(statement, parameters)
+        return cursor.lastrowid, cursor.fetchall()
+
+    # the event loop hands statements to the journal thread instead of waiting for the disk
+    async def run(self, statement, parameters=()):
+        return await asyncio.get_running_loop().run_in_executor(self.thread, self.execute, statement, parameters)
+
+    async def start(self, chat_id, locale, operation, args, kwargs):
+        now = time.time()
+        entry_id, _ = await self.run(
+            'INSERT INTO journal (chat_id, locale, operation, arguments, created, updated) VALUES (?, ?, ?, ?, ?, ?)',
+            (chat_id, locale, operation, json.dumps([args, kwargs]), now, now))
+        return entry_id
+
+    async def running(self, entry_id):
+        await self.run("UPDATE journal SET stage = 'running', attempts = attempts + 1, updated = ? "
+                       "WHERE id = ?", (time.time(), entry_id))
+
+    async def done(self, entry_id, output):
+        await self.run("UPDATE journal SET stage = 'done', output = ?, updated = ? WHERE id = ?",
+                       (output, time.time(), entry_id))
+
+    async def finish(self, entry_id, stage):
+        await self.run('UPDATE journal SET stage = ?, updated = ? WHERE id = ?', (stage, time.time(), entry_id))
+
+    # the output was sent to the user, it is found by its path as every job writes to its own workspace
+    async def delivered(self, output):
+        await self.run("UPDATE journal SET stage = 'delivered', updated = ? "
+                       "WHERE output = ? AND stage = 'done'", (time.time(), output))
+
+    # the output could not be sent, the user was told the job failed
+    async def undelivered(self, output):
+        await self.run("UPDATE journal SET stage = 'failed', updated = ? "
+                       "WHERE output = ? AND stage = 'done'", (time.time(), output))
+
+    async def unfinished(self):
+        _, rows = await self.run(
+            "SELECT id, chat_id, locale, operation, arguments, stage, attempts, output FROM journal "
+            "WHERE stage IN ('queued', 'running', 'done') ORDER BY id")
+        entries = []
+        for entry_id, chat_id, locale, operation, arguments, stage, attempts, output in rows:
+            args, kwargs = json.loads(arguments)
+            entries.append(JournalEntry(entry_id, chat_id, locale, operation, args, kwargs, stage, attempts, output))
+        return entries
+
+    # runs in the journal thread
+    def purge(self):
+        self.execute("DELETE FROM journal WHERE stage IN ('delivered', 'failed', 'cancelled') "
+                     "AND updated < ?", (time.time() - keep_finished,))
+
+
+journal = JobJournal()
+
+
+# the purge is queued in the journal thread ahead of every other statement
+def configure(path):
+    journal.path = path
+    journal.db = None
+    journal.thread.submit(journal.purge)
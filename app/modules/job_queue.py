@@ -0,0 +1,179 @@
+# durable queue between the bot and worker processes started with `python bot.py --worker`:
+# jobs and their results are rows of a local sqlite database, so any number of workers can be
+# started and stopped on their own while the bot keeps polling
+import asyncio
+import functools
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from app.tools import supervisor
+
+logger = logging.getLogger(__name__)
+
+# seconds between result checks of the bot and heartbeats of a worker
+poll_interval = 0.2
+heartbeat_interval = 2
+# a running job without heartbeats for this long lost its worker and goes back to the queue,
+# at most max_attempts times so a job that kills its worker cannot kill them all
+stale_after = 60
+max_attempts = 2
+# finished jobs nobody picked up are dropped after this many seconds
+keep_finished = 24 * 3600
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    operation TEXT NOT NULL,
+    arguments TEXT NOT NULL,
+    owner TEXT,
+    state TEXT NOT NULL DEFAULT 'queued',
+    worker TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    error TEXT,
+    created REAL NOT NULL,
+    heartbeat REAL
+)'''
+
+
+class RemoteJobError(Exception):
+    pass
+
+
+class JobQueue:
+    """Jobs go queued -> running -> done, failed or cancelled; cancelling marks a running job
+    whose owner cancelled it, its worker stops the tools and reports it cancelled."""
+
+    def __init__(self, path=os.path.join('cache', 'jobs.sqlite')):
+        self.path = path
+        self.local = threading.local()
+
+    # every thread gets its own connection, sqlite connections must not be shared
+    def connection(self):
+        if getattr(self.local, 'connection', None) is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(SCHEMA)
+            self.local.connection = connection
+        return self.local.connection
+
+    def put(self, operation, args, kwargs, owner):
+        cursor = self.connection().execute(
+            'INSERT INTO jobs (operation, arguments, owner, created) VALUES (?, ?, ?, ?)',
+            (operation, json.dumps([args, kwargs]), None if owner is None else str(owner), time.time()))
+        return cursor.lastrowid
+
+    # oldest queued job for worker, None when there is none
+    def claim(self, worker):
+        connection = self.connection()
+        now = time.time()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute("UPDATE jobs SET state = 'failed', error = 'the job stopped its worker' "
+                               "WHERE state IN ('running', 'cancelling') AND heartbeat < ? AND attempts >= ?",
+                               (now - stale_after, max_attempts))
+            connection.execute("UPDATE jobs SET state = 'queued', worker = NULL "
+                               "WHERE state = 'running' AND heartbeat < ?", (now - stale_after,))
+            connection.execute("UPDATE jobs SET state = 'cancelled' WHERE state = 'cancelling' AND heartbeat < ?",
+                               (now - stale_after,))
+            row = connection.execute("SELECT id, operation, arguments, owner FROM jobs WHERE state = 'queued' "
+                                     "ORDER BY id LIMIT 1").fetchone()
+            if row is not None:
+                connection.execute("UPDATE jobs SET state = 'running', worker = ?, attempts = attempts + 1, "
+                                   "heartbeat = ? WHERE id = ?", (worker, now, row[0]))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        if row is None:
+            return None
+        job_id, operation, arguments, owner = row
+        args, kwargs = json.loads(arguments)
+        return job_id, operation, args, kwargs, owner
+
+    # state of the job, a worker learns from it that the job was cancelled
+    def heartbeat(self, job_id):
+        connection = self.connection()
+        connection.execute('UPDATE jobs SET heartbeat = ? WHERE id = ?', (time.time(), job_id))
+        row = connection.execute('SELECT state FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return row[0] if row else None
+
+    def finish(self, job_id, result):
+        self.connection().execute(
+            "UPDATE jobs SET state = CASE state WHEN 'cancelling' THEN 'cancelled' ELSE 'done' END, result = ?, "
+            "heartbeat = ? WHERE id = ?", (json.dumps(result), time.time(), job_id))
+
+    def fail(self, job_id, error, cancelled=False):
+        self.connection().execute('UPDATE jobs SET state = ?, error = ?, heartbeat = ? WHERE id = ?',
+                                  ('cancelled' if cancelled else 'failed', error, time.time(), job_id))
+
+    def cancel(self, owner=None, job_id=None):
+        connection = self.connection()
+        column, value = ('id', job_id) if job_id is not None else ('owner', str(owner))
+        connection.execute("UPDATE jobs SET state = 'cancelled' WHERE state = 'queued' AND {} = ?".format(column),
+                           (value,))
+        connection.execute("UPDATE jobs SET state = 'cancelling' WHERE state = 'running' AND {} = ?".format(column),
+                           (value,))
+
+    # jobs of a previous run of the bot, nobody waits for them anymore
+    def abandon(self):
+        connection = self.connection()
+        connection.execute("UPDATE jobs SET state = 'cancelled' WHERE state = 'queued'")
+        connection.execute("UPDATE jobs SET state = 'cancelling' WHERE state = 'running'")
+
+    def result(self, job_id):
+        return self.connection().execute('SELECT state, result, error FROM jobs WHERE id = ?', (job_id,)).fetchone()
+
+    def remove(self, job_id):
+        self.connection().execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+
+    def purge(self):
+        self.connection().execute("DELETE FROM jobs WHERE state IN ('done', 'failed', 'cancelled') AND created < ?",
+                                  (time.time() - keep_finished,))
+
+    async def run(self, operation, args, kwargs, owner):
+        """Queue a job for the workers and wait for its result without blocking other updates.
+
+        Raises supervisor.ToolCancelled when the owner cancelled it and RemoteJobError when it failed.
+        """
+        loop = asyncio.get_running_loop()
+        job_id = await loop.run_in_executor(None, self.put, operation, args, kwargs, owner)
+        state = None
+        try:
+            while True:
+                await asyncio.sleep(poll_interval)
+                state, result, error = await loop.run_in_executor(None, self.result, job_id)
+                if state == 'done':
+                    return json.loads(result)
+                if state in ('cancelling', 'cancelled'):
+                    raise supervisor.ToolCancelled('{} was cancelled'.format(operation))
+                if state == 'failed':
+                    raise RemoteJobError('{} failed in a worker: {}'.format(operation, error))
+        except asyncio.CancelledError:
+            await loop.run_in_executor(None, functools.partial(self.cancel, job_id=job_id))
+            raise
+        finally:
+            # a job still running stays until its worker lets go of it
+            if state in ('done', 'failed', 'cancelled'):
+                await loop.run_in_executor(None, self.remove, job_id)
+
+
+# None keeps every tool in the bot process
+queue = None
+
+
+def configure(path):
+    global queue
+    queue = JobQueue(path)
+    queue.purge()
+
+
+# stop jobs of owner, wherever they run; workers may hold the database for a while
+async def cancel(owner):
+    if queue is not None:
+        await asyncio.get_running_loop().run_in_executor(None, queue.cancel, owner)
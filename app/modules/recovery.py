@@ -0,0 +1,100 @@
+# picks up what a previous run of the bot left in the job journal: jobs that were waiting or
+# running are run again or failed with a message to their user, outputs that were ready but
+# never sent are sent, and workspaces nothing refers to anymore are removed
+import asyncio
+import contextlib
+import logging
+import os
+
+from aiogram.utils.exceptions import TelegramAPIError
+
+from app.modules.cost_estimator import cost_estimator
+from app.modules.executor import run_tool
+from app.modules.job_journal import journal
+from app.modules.read_messages import errors_dict, txt_dict
+from app.modules.scheduler import scheduler
+from app.modules.workspace import workspaces
+from app.tools import supervisor
+
+logger = logging.getLogger(__name__)
+
+# a job that was running when the bot went down this many times is not tried again
+max_attempts = 2
+
+
+# what to do with every unfinished entry; runs before polling starts, so no workspace is in use
+# other than the ones in keep
+async def plan(keep=()):
+    plans = []
+    keep = set(keep)
+    for entry in await journal.unfinished():
+        if entry.stage == 'done':
+            action = deliver if entry.output and os.path.exists(entry.output) else fail
+        elif entry.attempts < max_attempts and all(os.path.exists(f) for f in entry.inputs()):
+            action = resume
+        else:
+            action = fail
+        if action is not fail:
+            keep.add(workspaces.name_of(entry.output or entry.inputs()[0]))
+        plans.append((action, entry))
+    workspaces.remove_stale(keep)
+    if plans:
+        logger.info('Recovering %d job(s) of the previous run', len(plans))
+    return plans
+
+
+async def recover(bot, plans):
+    await asyncio.gather(*(action(bot, entry) for action, entry in plans))
+
+
+async def resume(bot, entry):
+    supervisor.owner.set(entry.chat_id)
+    try:
+        units = await cost_estimator.units(entry.operation, entry.args[0])
+        seconds = cost_estimator.estimate(entry.operation, units)
+        async with scheduler.slot(entry.chat_id, entry.operation, seconds):
+            await journal.running(entry.id)
+            entry.output = await run_tool(entry.operation, *entry.args, **entry.kwargs)
+    except supervisor.ToolCancelled:
+        await journal.finish(entry.id, 'cancelled')
+        release(entry)
+        return
+    except Exception as e:
+        logger.error('Job %d (%s) of %s raised error %s while resuming', entry.id, entry.operation,
+                     entry.chat_id, e)
+        await fail(bot, entry)
+        return
+    if entry.output is None:
+        await fail(bot, entry)
+        return
+    await journal.done(entry.id, entry.output)
+    await deliver(bot, entry)
+
+
+async def deliver(bot, entry):
+    try:
+        await bot.send_message(entry.chat_id, txt_dict['job_recovered_text'][entry.locale])
+        with open(entry.output, 'rb') as output:
+            await bot.send_document(entry.chat_id, output)
+        await journal.delivered(entry.output)
+        logger.info('Job %d (%s) of %s was delivered after a restart', entry.id, entry.operation, entry.chat_id)
+    except (TelegramAPIError, OSError) as e:
+        # the output may also be gone since the plan was made
+        await journal.finish(entry.id, 'failed')
+        logger.error('Job %d (%s) of %s could not be delivered: %s', entry.id, entry.operation, entry.chat_id, e)
+    finally:
+        release(entry)
+
+
+async def fail(bot, entry):
+    await journal.finish(entry.id, 'failed')
+    logger.info('Job %d (%s) of %s was lost with a restart', entry.id, entry.operation, entry.chat_id)
+    with contextlib.suppress(TelegramAPIError):
+        await bot.send_message(entry.chat_id, errors_dict['job_interrupted'][entry.locale])
+    release(entry)
+
+
+def release(entry):
+    name = workspaces.name_of(entry.output or entry.inputs()[0])
+    if name is not None:
+        workspaces.release(name)
@@ -0,0 +1,146 @@
+# cache of sent results: request fingerprint -> telegram file_id of the uploaded output;
+# changes are saved together every save_interval seconds by an executor thread
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+
+from aiogram import types
+from aiogram.utils.exceptions import TelegramAPIError
+
+from app.modules.job_journal import journal
+
+logger = logging.getLogger(__name__)
+
+
+class ResultCache:
+    def __init__(self, path=os.path.join('cache', 'results.json'), ttl=7 * 24 * 3600, max_entries=10000,
+                 save_interval=5.0):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.save_interval = save_interval
+        self.entries = None
+        self.dirty = False
+        self.saver = None
+        self.save_lock = None
+
+    def load(self):
+        self.entries = OrderedDict()
+        try:
+            with open(self.path, 'r', encoding='utf8') as file:
+                stored = json.load(file)
+        except (FileNotFoundError, ValueError):
+            stored = []
+        now = time.time()
+        for key, file_id, created in stored:
+            if now - created < self.ttl:
+                self.entries[key] = (file_id, created)
+
+    def save(self, stored):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w', encoding='utf8') as file:
+            json.dump(stored, file)
+        os.replace(temp_path, self.path)
+
+    def changed(self):
+        self.dirty = True
+        if self.saver is None or self.saver.done():
+            self.saver = asyncio.get_running_loop().create_task(self.save_later())
+
+    # changes made while a save is written are saved by the next round
+    async def save_later(self):
+        while self.dirty:
+            await asyncio.sleep(self.save_interval)
+            await self.flush()
+
+    async def flush(self):
+        if self.save_lock is None:
+            self.save_lock = asyncio.Lock()
+        async with self.save_lock:
+            if not self.dirty:
+                return
+            self.dirty = False
+            stored = [[key, file_id, created] for key, (file_id, created) in self.entries.items()]
+            await asyncio.get_running_loop().run_in_executor(None, self.save, stored)
+
+    # a save being written is waited for, so the last one wins
+    async def close(self):
+        await self.flush()
+        if self.saver is not None:
+            self.saver.cancel()
+
+    def get(self, key):
+        if self.entries is None:
+            self.load()
+        if key not in self.entries:
+            return None
+        file_id, created = self.entries[key]
+        if time.time() - created >= self.ttl:
+            self.drop(key)
+            return None
+        return file_id
+
+    def put(self, key, file_id):
+        if self.entries is None:
+            self.load()
+        self.entries.pop(key, None)
+        self.entries[key] = (file_id, time.time())
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        self.changed()
+
+    def drop(self, key):
+        if self.entries.pop(key, None) is not None:
+            self.changed()
+
+
+# identical inputs (by file_unique_id and name), operation and parameters give the same fingerprint
+def fingerprint(operation, file_unique_ids, file_paths, **params):
+    request = [operation, file_unique_ids, [os.path.basename(f) for f in file_paths], sorted(params.items())]
+    return hashlib.sha256(json.dumps(request).encode('utf8')).hexdigest()
+
+
+result_cache = ResultCache()
+
+
+def configure(path, ttl, max_entries):
+    result_cache.path = path
+    result_cache.ttl = ttl
+    result_cache.max_entries = max_entries
+    result_cache.load()
+
+
+# resend a cached result, False means it has to be computed
+async def answer_cached(message: types.Message, key):
+    file_id = result_cache.get(key)
+    if file_id is None:
+        return False
+    try:
+        await types.ChatActions.upload_document()
+        await message.answer_document(file_id)
+    except TelegramAPIError as e:
+        logger.error('Cached result "%s" could not be sent: %s', file_id, e)
+        result_cache.drop(key)
+        return False
+    logger.info('User "%s" (%s) got cached result "%s"',
+                message.from_user.id, message.from_user.username, file_id)
+    return True
+
+
+# send the output of a job and remember it for identical requests
+async def answer_result(message: types.Message, key, output_path):
+    try:
+        await types.ChatActions.upload_document()
+        with open(output_path, 'rb') as output:
+            sent = await message.answer_document(output)
+    except Exception:
+        # otherwise the entry would stay done and be reported as lost after the next restart
+        await journal.undelivered(output_path)
+        raise
+    result_cache.put(key, sent.document.file_id)
+    await journal.delivered(output_path)
@@ -0,0 +1,163 @@
+# central queue in front of the tools: at most slots jobs run at once and per_user of them for
+# one user; jobs expected to be quick go first and users with jobs of the same size are served in turn
+import asyncio
+import contextlib
+import itertools
+import logging
+import math
+import os
+import time
+
+from app.modules.cost_estimator import cost_estimator
+from app.modules.executor import run_tool
+from app.modules.job_journal import journal
+from app.modules.read_messages import txt_dict
+from app.tools import supervisor
+
+logger = logging.getLogger(__name__)
+
+# estimated seconds a waiting job loses per second, so big jobs cannot wait forever behind small ones
+aging = 1.0
+
+
+class JobRejected(Exception):
+    # key of the answer in errors_dict
+    error = 'func_failed'
+
+
+class QueueFull(JobRejected):
+    error = 'server_busy'
+
+
+class JobTooHeavy(JobRejected):
+    error = 'job_too_heavy'
+
+
+class Job:
+    def __init__(self, owner, operation, cost, seq):
+        self.owner = owner
+        self.operation = operation
+        self.cost = cost
+        self.seq = seq
+        self.queued = time.monotonic()
+        self.ready = asyncio.get_running_loop().create_future()
+
+    # jobs of one size class are served round-robin, the classes grow twice as big each
+    def size_class(self, now):
+        return int(math.log2(1 + max(0.0, self.cost - aging * (now - self.queued))))
+
+
+class Scheduler:
+    def __init__(self, slots=os.cpu_count() or 1, per_user=1, max_queued=100):
+        self.slots = slots
+        self.per_user = per_user
+        self.max_queued = max_queued
+        self.waiting = []
+        self.running = {}
+        self.served = {}
+        self.counter = itertools.count()
+
+    def key(self, job, now):
+        return job.size_class(now), self.served.get(job.owner, -1), job.seq
+
+    # jobs that would start before this one, plus one
+    def position(self, job):
+        now = time.monotonic()
+        return 1 + sum(1 for other in self.waiting if self.key(other, now) < self.key(job, now))
+
+    def submit(self, owner, operation, cost):
+        job = Job(owner, operation, cost, next(self.counter))
+        self.waiting.append(job)
+        self.dispatch()
+        if len(self.waiting) > self.max_queued and job in self.waiting:
+            self.waiting.remove(job)
+            raise QueueFull('{} jobs are waiting already'.format(len(self.waiting)))
+        return job
+
+    def dispatch(self):
+        now = time.monotonic()
+        while sum(self.running.values()) < self.slots:
+            ready = [job for job in self.waiting if self.running.get(job.owner, 0) < self.per_user]
+            if not ready:
+                break
+            job = min(ready, key=lambda job: self.key(job, now))
+            self.waiting.remove(job)
+            self.running[job.owner] = self.running.get(job.owner, 0) + 1
+            self.served[job.owner] = job.seq
+            job.ready.set_result(True)
+
+    def finish(self, job):
+        self.running[job.owner] -= 1
+        if not self.running[job.owner]:
+            del self.running[job.owner]
+            # users come back with new jobs all the time, only the ones waiting need their turn kept
+            if not any(other.owner == job.owner for other in self.waiting):
+                self.served.pop(job.owner, None)
+        self.dispatch()
+
+    # drop waiting jobs of owner, the running ones are stopped by supervisor.cancel()
+    def cancel(self, owner):
+        for job in [job for job in self.waiting if job.owner == owner]:
+            self.waiting.remove(job)
+            job.ready.set_exception(supervisor.ToolCancelled('{} was cancelled in the queue'.format(job.operation)))
+
+    @contextlib.asynccontextmanager
+    async def slot(self, owner, operation, cost, on_wait=None):
+        job = self.submit(owner, operation, cost)
+        try:
+            if not job.ready.done():
+                logger.info('Job %s of %s waits at position %d', operation, owner, self.position(job))
+                if on_wait is not None:
+                    await on_wait(self.position(job))
+            await job.ready
+        except BaseException:
+            if job in self.waiting:
+                self.waiting.remove(job)
+            elif job.ready.done() and not job.ready.cancelled() and job.ready.exception() is None:
+                self.finish(job)
+            raise
+        try:
+            yield job
+        finally:
+            self.finish(job)
+
+
+scheduler = Scheduler()
+
+
+def configure(slots, per_user, max_queued):
+    scheduler.slots = max(1, slots)
+    scheduler.per_user = max(1, per_user)
+    scheduler.max_queued = max(0, max_queued)
+
+
+# run_tool for a job of the user who sent message, behind the other jobs in the queue
+async def run_job(message, operation, *args, **kwargs):
+    locale = str(message.from_user.locale) if str(message.from_user.locale) in ['en', 'ru'] else 'en'
+    units = await cost_estimator.units(operation, args[0])
+    seconds = cost_estimator.estimate(operation, units)
+    if cost_estimator.too_heavy(seconds):
+        raise JobTooHeavy('{} would take about {:.0f} s'.format(operation, seconds))
+
+    async def on_wait(position):
+        await message.answer(txt_dict['queue_position_text'][locale].format(position))
+
+    # a job interrupted by a restart stays queued or running in the journal and is picked up again
+    entry_id = await journal.start(message.chat.id, locale, operation, args, kwargs)
+    try:
+        async with scheduler.slot(message.from_user.id, operation, seconds, on_wait):
+            await journal.running(entry_id)
+            started = time.monotonic()
+            output_path = await run_tool(operation, *args, **kwargs)
+            cost_estimator.record(operation, units, time.monotonic() - started)
+    except supervisor.ToolCancelled:
+        await journal.finish(entry_id, 'cancelled')
+        raise
+    except Exception:
+        await journal.finish(entry_id, 'failed')
+        raise
+    if output_path is None:
+        await journal.finish(entry_id, 'failed')
+    else:
+        await journal.done(entry_id, output_path)
+    return output_path
@@ -0,0 +1,51 @@
+# collect files of one batch (album or several forwarded documents) and react once per batch
+import asyncio
+import contextlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class UploadAggregator:
+    """Calls ``callback`` once per batch of uploads sharing the same key.
+
+    The timer is armed only when no upload of the key is still in progress, and every new upload
+    restarts it, so slow downloads inside an album do not split the batch.
+    """
+
+    def __init__(self, callback, delay=0.5):
+        self.callback = callback
+        self.delay = delay
+        self.pending = {}
+        self.timers = {}
+        self.tasks = set()
+
+    @contextlib.contextmanager
+    def collect(self, key, *args):
+        timer = self.timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        self.pending[key] = self.pending.get(key, 0) + 1
+        try:
+            yield
+        finally:
+            self.pending[key] -= 1
+            if self.pending[key] == 0:
+                del self.pending[key]
+                loop = asyncio.get_running_loop()
+                self.timers[key] = loop.call_later(self.delay, self._fire, key, args)
+
+    def _fire(self, key, args):
+        del self.timers[key]
+        task = asyncio.create_task(self.callback(*args))
+        self.tasks.add(task)
+        task.add_done_callback(self._done)
+
+    def _done(self, task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error('Batch callback raised error %s', task.exception())
+
+
+def batch_key(message):
+    return message.chat.id, message.from_user.id, message.media_group_id
@@ -0,0 +1,54 @@
+# worker process: takes jobs the bot put to the job queue and runs the tools for them, one at a time
+import contextvars
+import logging
+import os
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from app.modules import executor
+from app.modules.job_queue import heartbeat_interval
+from app.tools import supervisor
+
+logger = logging.getLogger(__name__)
+
+# seconds to sleep when the queue is empty
+idle_interval = 0.5
+
+
+def run(queue):
+    name = '{}:{}'.format(socket.gethostname(), os.getpid())
+    logger.info('Worker %s is waiting for jobs in %s', name, queue.path)
+    # the tool runs in a thread, so this one can keep the heartbeat and watch for cancellation
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix='job') as pool:
+        while True:
+            job = queue.claim(name)
+            if job is None:
+                time.sleep(idle_interval)
+            else:
+                execute(queue, pool, *job)
+
+
+def execute(queue, pool, job_id, operation, args, kwargs, owner):
+    function, _ = executor.operations[operation]
+    context = contextvars.copy_context()
+    context.run(supervisor.owner.set, owner)
+    started = time.monotonic()
+    job = pool.submit(context.run, supervisor.as_job, function, *args, **kwargs)
+    cancelled = False
+    while not wait([job], timeout=heartbeat_interval).done:
+        # a job removed by the bot is not waited for anymore either
+        if queue.heartbeat(job_id) in ('cancelling', None) and not cancelled:
+            cancelled = True
+            supervisor.cancel(owner)
+    try:
+        result = job.result()
+    except supervisor.ToolCancelled as e:
+        queue.fail(job_id, str(e), cancelled=True)
+        logger.info('Job %d (%s) was cancelled', job_id, operation)
+    except Exception as e:
+        queue.fail(job_id, '{}: {}'.format(type(e).__name__, e))
+        logger.error('Job %d (%s) raised error %s', job_id, operation, e)
+    else:
+        queue.finish(job_id, result)
+        logger.info('Job %d (%s) took %.1f s', job_id, operation, time.monotonic() - started)
@@ -0,0 +1,161 @@
+# every job gets its own working directory, removed in the background once the job is over
+# and nothing uses it anymore; small jobs can be kept on a RAM backed filesystem
+import contextlib
+import logging
+import os
+import shutil
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from app.tools.reader_cache import reader_cache
+
+logger = logging.getLogger(__name__)
+
+
+class Workspace:
+    def __init__(self, name, disk_dir, ram_dir=None):
+        self.name = name
+        self.disk_dir = disk_dir
+        self.ram_dir = ram_dir
+        # bytes reserved on the RAM filesystem, twice the inputs to leave room for the output
+        self.ram_bytes = 0
+        self.spilled = ram_dir is None
+        self.users = 0
+        self.released = False
+
+    def folders(self):
+        return [folder for folder in (self.ram_dir, self.disk_dir) if folder is not None]
+
+
+class WorkspaceManager:
+    """Workspaces are named '<owner>/<id>' and live under root, or under ram_root while they stay
+    within ram_job_bytes and all of them together within ram_max_bytes; a job outgrowing that
+    spills its next files and its output to root."""
+
+    def __init__(self, root='temp', ram_root='', ram_max_bytes=256 * 1024 * 1024, ram_job_bytes=32 * 1024 * 1024):
+        self.root = root
+        self.ram_root = ram_root
+        self.ram_max_bytes = ram_max_bytes
+        self.ram_job_bytes = ram_job_bytes
+        self.ram_used = 0
+        self.workspaces = {}
+        self.lock = threading.Lock()
+        self.remover = ThreadPoolExecutor(max_workers=1, thread_name_prefix='workspace')
+
+    def create(self, owner):
+        return self.get(os.path.join(str(owner), uuid.uuid4().hex[:12])).name
+
+    # workspaces are rebuilt from their names, so names kept in user state outlive a restart
+    def get(self, name):
+        with self.lock:
+            if name not in self.workspaces:
+                ram_dir = os.path.join(self.ram_root, name) if self.ram_root else None
+                self.workspaces[name] = Workspace(name, os.path.join(self.root, name), ram_dir)
+            return self.workspaces[name]
+
+    # where an uploaded file of size bytes goes
+    def file_path(self, name, file_name, size):
+        workspace = self.get(name)
+        with self.lock:
+            needed = 2 * size
+            if not workspace.spilled and workspace.ram_bytes + needed <= self.ram_job_bytes \
+                    and self.ram_used + needed <= self.ram_max_bytes:
+                workspace.ram_bytes += needed
+                self.ram_used += needed
+                folder = workspace.ram_dir
+            else:
+                if not workspace.spilled:
+                    logger.info('Workspace %s spills to disk', name)
+                workspace.spilled = True
+                folder = workspace.disk_dir
+        os.makedirs(folder, exist_ok=True)
+        return os.path.join(folder, file_name)
+
+    def output_folder(self, name):
+        workspace = self.get(name)
+        folder = workspace.disk_dir if workspace.spilled else workspace.ram_dir
+        os.makedirs(folder, exist_ok=True)
+        return folder
+
+    # a job reading or writing its files holds the workspace, release() waits for it
+    @contextlib.contextmanager
+    def use(self, name):
+        workspace = self.get(name)
+        with self.lock:
+            workspace.users += 1
+        try:
+            yield workspace
+        finally:
+            with self.lock:
+                workspace.users -= 1
+                remove = workspace.released and workspace.users == 0
+            if remove:
+                self.remove(workspace)
+
+    def release(self, name):
+        workspace = self.get(name)
+        with self.lock:
+            workspace.released = True
+            remove = workspace.users == 0
+        if remove:
+            self.remove(workspace)
+
+    def remove(self, workspace):
+        with self.lock:
+            if self.workspaces.get(workspace.name) is not workspace:
+                return
+            del self.workspaces[workspace.name]
+        for folder in workspace.folders():
+            reader_cache.evict(folder)
+        # deleting big batches takes a while, it never happens on the event loop
+        self.remover.submit(self.delete, workspace)
+
+    # name of the workspace path is in, None for paths outside of workspaces
+    def name_of(self, path):
+        for root in (self.root, self.ram_root):
+            if not root:
+                continue
+            relative = os.path.relpath(os.path.abspath(path), os.path.abspath(root))
+            parts = relative.split(os.sep)
+            if len(parts) >= 2 and parts[0].isdigit():
+                return os.path.join(parts[0], parts[1])
+        return None
+
+    # workspaces left by a previous run, except the ones in keep, are removed
+    def remove_stale(self, keep):
+        for root in (self.root, self.ram_root):
+            if not root or not os.path.isdir(root):
+                continue
+            # other folders under root, like libreoffice profiles, are not workspaces
+            for owner in filter(str.isdigit, os.listdir(root)):
+                for name in os.listdir(os.path.join(root, owner)):
+                    if os.path.join(owner, name) not in keep:
+                        self.release(os.path.join(owner, name))
+
+    def delete(self, workspace):
+        for folder in workspace.folders():
+            shutil.rmtree(folder, ignore_errors=True)
+            # the owner folder goes too once its last workspace is gone
+            with contextlib.suppress(OSError):
+                os.rmdir(os.path.dirname(folder))
+        with self.lock:
+            self.ram_used -= workspace.ram_bytes
+
+
+workspaces = WorkspaceManager()
+
+
+def configure(root, ram_root, ram_max_bytes, ram_job_bytes):
+    workspaces.root = root
+    workspaces.ram_root = ram_root
+    workspaces.ram_max_bytes = ram_max_bytes
+    workspaces.ram_job_bytes = ram_job_bytes
+
+
+# new workspace for a job kept in state, the one of a job left unfinished is released
+async def start_workspace(state, owner):
+    user_data = await state.get_data()
+    if user_data.get('workspace'):
+        workspaces.release(user_data['workspace'])
+    return workspaces.create(owner)
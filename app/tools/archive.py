@@ -0,0 +1,41 @@
+# zip archives written member by member straight from buffers, pipes or files
+import os
+import shutil
+import time
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED
+
+# pdf and image streams are compressed already, deflating them again costs cpu for almost no gain
+stored_extensions = {'pdf', 'zip', 'jpg', 'jpeg', 'png', 'gif', 'webp'}
+copy_buffer_size = 1024 * 1024
+
+
+class StreamingZip:
+    def __init__(self, output_path):
+        self.zip = ZipFile(output_path, 'w')
+
+    def member(self, name):
+        info = ZipInfo(name, date_time=time.localtime()[:6])
+        info.compress_type = ZIP_STORED if name.split('.')[-1].lower() in stored_extensions else ZIP_DEFLATED
+        return info
+
+    def write_bytes(self, name, data):
+        self.zip.writestr(self.member(name), data)
+
+    def write_stream(self, name, stream):
+        with self.zip.open(self.member(name), 'w') as member:
+            shutil.copyfileobj(stream, member, copy_buffer_size)
+
+    # move a file produced by an external tool into the archive
+    def write_file(self, name, file_path):
+        with open(file_path, 'rb') as stream:
+            self.write_stream(name, stream)
+        os.remove(file_path)
+
+    def close(self):
+        self.zip.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,257 @@
+# single document compression; big documents are cut into page ranges compressed by
+# several ghostscript processes at once and put back together afterwards.
+# In adaptive mode the level is picked from what the document is made of, several levels
+# may be tried at once, and the original is kept when ghostscript cannot make it smaller
+import logging
+import math
+import os
+import shutil
+from io import BytesIO
+
+from PyPDF2.generic import ArrayObject
+
+from app.tools import image_compressor, page_splitter, pdf_compressor, pdf_probe, supervisor
+from app.tools.pdf_writer import merge_documents
+from app.tools.reader_cache import reader_cache
+
+logger = logging.getLogger(__name__)
+
+# documents of shard_min_size bytes and at least two shards of shard_min_pages pages are sharded,
+# ghostscript time follows the pages more than the bytes; shard_workers below 2 keeps one
+# ghostscript per document. Off by default: merging the shards keeps pages, bookmarks and named
+# destinations, but drops forms, page labels and optional content, and font subsets of the shards
+# are kept side by side
+shard_workers = 1
+shard_min_size = 0
+shard_min_pages = 40
+
+adaptive = True
+# a candidate at most good_ratio of the original is taken without waiting for weaker levels
+good_ratio = 0.7
+sample_pages = 20
+# images above this resolution are worth downsampling to the 150 dpi of /ebook
+high_resolution = 200
+
+
+def configure(workers, min_size, min_pages, adaptive_mode=True):
+    global shard_workers, shard_min_size, shard_min_pages, adaptive
+    shard_workers, shard_min_size, shard_min_pages = workers, min_size, max(1, min_pages)
+    adaptive = adaptive_mode
+
+
+class DocumentProfile:
+    """What a sample of pages says about the document: share of the file taken by images,
+    their resolution and the share of content streams and fonts stored without compression."""
+
+    def __init__(self, image_share, image_ppi, raw_share):
+        self.image_share = image_share
+        self.image_ppi = image_ppi
+        self.raw_share = raw_share
+
+    # ghostscript levels worth trying, the best quality first; empty when nothing would be gained
+    def levels(self):
+        if self.image_share >= 0.3 and self.image_ppi > high_resolution:
+            return [0, 3]
+        if self.image_share >= 0.3 or self.raw_share >= 0.1:
+            return [0]
+        return []
+
+
+def inspect(file_path):
+    with reader_cache.use(file_path) as pdf_reader:
+        return read_profile(pdf_reader, file_path)
+
+
+# looks at up to sample_pages pages spread over the document and extrapolates to all of it
+def read_profile(pdf_reader, file_path):
+    num_of_pages = pdf_reader.getNumPages()
+    sampled = range(0, num_of_pages, max(1, num_of_pages // sample_pages))
+    seen = set()
+    image_bytes = image_pixels = image_area = raw_bytes = 0
+    for i in sampled:
+        page = pdf_reader.getPage(i)
+        if '/Contents' not in page:
+            continue
+        contents = page['/Contents']
+        for part in (contents if isinstance(contents, ArrayObject) else [contents]):
+            part = part.getObject()
+            if '/Filter' not in part:
+                raw_bytes += len(part._data)
+        resources = page['/Resources'] if '/Resources' in page else {}
+        fonts = resources['/Font'] if '/Font' in resources else {}
+        for font in fonts.values():
+            raw_bytes += sum(len(font_file._data) for font_file in font_files(font.getObject(), seen)
+                             if '/Filter' not in font_file)
+        xobjects = resources['/XObject'] if '/XObject' in resources else {}
+        if not xobjects:
+            continue
+        # only images the page draws, many documents hang all their images on every page
+        try:
+            names = page_splitter.content_names(page['/Contents'])
+        except Exception:
+            names = set(xobjects)
+        page_pixels = 0
+        for name in names & set(xobjects):
+            image = xobjects[name]
+            if image.get('/Subtype') != '/Image':
+                continue
+            page_pixels += int(image.get('/Width', 0)) * int(image.get('/Height', 0))
+            if id(image) not in seen:
+                seen.add(id(image))
+                image_bytes += len(image._data)
+        if page_pixels:
+            image_pixels += page_pixels
+            # square inches
+            image_area += abs(float(page.mediaBox.getWidth()) * float(page.mediaBox.getHeight())) / 72 ** 2
+    scale = num_of_pages / len(sampled) / max(1, os.path.getsize(file_path))
+    image_ppi = math.sqrt(image_pixels / image_area) if image_area else 0
+    return DocumentProfile(min(1.0, image_bytes * scale), image_ppi, min(1.0, raw_bytes * scale))
+
+
+def font_files(font, seen):
+    fonts = [font] + [descendant.getObject() for descendant in font.get('/DescendantFonts', [])]
+    for font in fonts:
+        descriptor = font['/FontDescriptor'] if '/FontDescriptor' in font else {}
+        for key in ('/FontFile', '/FontFile2', '/FontFile3'):
+            if key in descriptor and id(descriptor[key]) not in seen:
+                seen.add(id(descriptor[key]))
+                yield descriptor[key]
+
+
+# page ranges the document is compressed in, a single range when sharding does not pay off
+def shard_ranges(file_path):
+    if shard_workers < 2 or os.path.getsize(file_path) < shard_min_size:
+        return [(None, None)]
+    try:
+        num_of_pages = pdf_probe.count_pages(file_path)
+    except Exception:
+        return [(None, None)]
+    shards = min(shard_workers, num_of_pages // shard_min_pages)
+    if shards < 2:
+        return [(None, None)]
+    bounds = [num_of_pages * i // shards for i in range(shards + 1)]
+    return [(bounds[i] + 1, bounds[i + 1]) for i in range(shards)]
+
+
+def compress_document(file_path, output_path, power=None, engine='ghostscript'):
+    """Compress with the given ghostscript level, or pick one in adaptive mode when it is None.
+
+    The 'images' engine re-encodes images only and leaves the rest of the document as it is.
+    The result is never bigger than the original, which is copied over when compression does not help.
+    """
+    if engine == 'images':
+        with open(output_path, 'wb') as output:
+            image_compressor.compress_images(file_path, output)
+        levels = []
+    else:
+        levels = choose_levels(file_path, power)
+    if levels:
+        ranges = shard_ranges(file_path)
+        if len(ranges) > 1:
+            # shards already keep the cores busy, only the best quality candidate is tried
+            compress_shards(file_path, output_path, levels[0], ranges)
+        elif len(levels) > 1:
+            try_levels(file_path, output_path, levels)
+        else:
+            pdf_compressor.compress(file_path, output_path, levels[0])
+    if not os.path.exists(output_path) or os.path.getsize(output_path) >= os.path.getsize(file_path):
+        shutil.copyfile(file_path, output_path)
+    return output_path
+
+
+# levels to compress the document with, empty when it is best kept as it is
+def choose_levels(file_path, power=None):
+    if power is not None or not adaptive:
+        return [power or 0]
+    try:
+        levels = inspect(file_path).levels()
+    except Exception as error:
+        logger.warning('Could not inspect %s, using the default level: %s', file_path, error)
+        return [0]
+    if not levels:
+        logger.info('Nothing to gain from compressing %s, keeping it as it is', file_path)
+    return levels
+
+
+# document of a batch as bytes, None when it is best kept as it is; the batch itself already
+# keeps the cores busy, so only the best quality level worth trying is run
+def compress_to_bytes(file_path, engine='ghostscript'):
+    if engine == 'images':
+        output = BytesIO()
+        image_compressor.compress_images(file_path, output)
+        return output.getvalue()
+    levels = choose_levels(file_path)
+    if not levels:
+        return None
+    return pdf_compressor.compress(file_path, '-', levels[0])
+
+
+# candidates run at once as far as free ghostscript slots allow, the rest run once the ones
+# before them are done; they are looked at in order of quality, the first one that is good
+# enough wins and the ones still running are stopped, otherwise the smallest one wins
+def try_levels(file_path, output_path, levels):
+    original_size = os.path.getsize(file_path)
+    candidates = []
+    try:
+        # once a candidate finds no free slot, the ones after it are not started ahead of it either,
+        # so a candidate waiting for a slot never holds slots of its own
+        starting = True
+        for level in levels:
+            candidate_path = '{}.level{}'.format(output_path, level)
+            process = None
+            if starting:
+                try:
+                    process = supervisor.Process(pdf_compressor.build_command(file_path, candidate_path, level),
+                                                 blocking=not candidates)
+                except supervisor.NoSlot:
+                    starting = False
+            candidates.append((level, candidate_path, process))
+        best = None
+        for level, candidate_path, process in list(candidates):
+            candidates.remove((level, candidate_path, process))
+            try:
+                if process is None:
+                    process = supervisor.Process(pdf_compressor.build_command(file_path, candidate_path, level))
+                process.wait()
+            except supervisor.ToolCancelled:
+                raise
+            except supervisor.ToolError:
+                continue
+            if not os.path.exists(candidate_path):
+                continue
+            size = os.path.getsize(candidate_path)
+            if size < (best[2] if best else original_size):
+                best = (level, candidate_path, size)
+            if size <= original_size * good_ratio:
+                break
+        if best is not None:
+            level, candidate_path, size = best
+            os.replace(candidate_path, output_path)
+            logger.info('Compressed %s to %.0f%% with %s', file_path, 100 * size / original_size,
+                        pdf_compressor.quality[level])
+    finally:
+        for _, _, process in candidates:
+            if process is not None:
+                process.discard()
+        for level in levels:
+            candidate_path = '{}.level{}'.format(output_path, level)
+            if os.path.exists(candidate_path):
+                os.remove(candidate_path)
+
+
+def compress_shards(file_path, output_path, power, ranges):
+    logger.info('Compressing %s in %d shards', file_path, len(ranges))
+    shard_paths = ['{}.shard{}'.format(output_path, i) for i in range(len(ranges))]
+    try:
+        with supervisor.batch_pool(len(ranges)) as pool:
+            jobs = [supervisor.submit(pool, pdf_compressor.compress, file_path, shard_path, power, first_page,
+                                      last_page)
+                    for shard_path, (first_page, last_page) in zip(shard_paths, ranges)]
+            for job in jobs:
+                job.result()
+        # images and fonts that came out identical in several shards are written once
+        merge_documents(shard_paths, output_path)
+    finally:
+        for shard_path in shard_paths:
+            if os.path.exists(shard_path):
+                os.remove(shard_path)
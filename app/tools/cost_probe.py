@@ -0,0 +1,56 @@
+# cheap measures of how much work a file is for an operation, read without parsing the file:
+# pages of pdfs and office documents, slides of presentations, megapixels of images
+import logging
+import os
+import re
+import zipfile
+
+from PIL import Image
+
+from app.tools import pdf_probe
+
+logger = logging.getLogger(__name__)
+
+# units per megabyte for files the probes cannot look into
+fallback_units = {'compress': 10, 'merge': 10, 'split': 10, 'delete': 10, 'doc2pdf': 20, 'ppt2pdf': 10,
+                  'img2pdf': 5}
+# megabytes of a pdf that weigh as much as a page for ghostscript, images are most of the work
+compress_page_size = 0.1
+
+DOCX_PAGES = re.compile(rb'<Pages>(\d+)</Pages>')
+ODT_PAGES = re.compile(rb'meta:page-count="(\d+)"')
+ODP_SLIDES = re.compile(rb'<draw:page\b')
+PPTX_SLIDE = re.compile(r'ppt/slides/slide\d+\.xml$')
+
+
+def work_units(operation, file_path):
+    megabytes = os.path.getsize(file_path) / 1024 / 1024
+    try:
+        units = probe(operation, file_path, megabytes)
+    except Exception as e:
+        logger.info('Cost probe failed for "%s": %s', os.path.basename(file_path), e)
+        units = None
+    return units if units is not None else fallback_units[operation] * megabytes
+
+
+def probe(operation, file_path, megabytes):
+    extension = file_path.split('.')[-1].lower()
+    if operation == 'compress':
+        return pdf_probe.count_pages(file_path) + megabytes / compress_page_size
+    if operation in ('merge', 'split', 'delete'):
+        return pdf_probe.count_pages(file_path)
+    if operation == 'img2pdf':
+        with Image.open(file_path) as image:
+            return image.width * image.height / 1000000
+    if extension not in ('docx', 'pptx', 'odt', 'odp'):
+        return None
+    with zipfile.ZipFile(file_path) as archive:
+        if extension == 'pptx':
+            return sum(1 for name in archive.namelist() if PPTX_SLIDE.match(name))
+        if extension == 'odp':
+            return len(ODP_SLIDES.findall(archive.read('content.xml')))
+        if extension == 'docx':
+            match = DOCX_PAGES.search(archive.read('docProps/app.xml'))
+        else:
+            match = ODT_PAGES.search(archive.read('meta.xml'))
+        return int(match.group(1)) if match else None
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+Compression of scanned documents without a ghostscript re-render.
+
+Only image XObjects used by pages are downsampled to the target resolution and re-encoded, in worker
+processes; every other object is copied with its stream data untouched. An image is replaced only
+when the new one is smaller.
+
+Run as a script to compare it with ghostscript on a document:
+    python -m app.tools.image_compressor document.pdf
+"""
+import argparse
+import os
+import time
+import zlib
+from io import BytesIO
+
+from PIL import Image
+from PyPDF2 import PdfFileReader
+from PyPDF2.generic import ArrayObject
+
+from app.tools import image_converter, pdf_compressor
+from app.tools.pdf_writer import ObjectCopier, StreamingPdfWriter
+
+jpeg_quality = 75
+# a jpeg is only re-encoded at the same size when that saves at least this share of it
+min_jpeg_gain = 0.1
+color_modes = {'/DeviceRGB': 'RGB', '/DeviceGray': 'L'}
+
+
+class ImageJob:
+    """An image XObject that can be re-encoded, with the scale that brings it to the target resolution."""
+
+    def __init__(self, image, scale):
+        self.image = image
+        self.scale = scale
+
+    def arguments(self):
+        image = self.image
+        return (image._data, image['/Filter'], int(image['/Width']), int(image['/Height']),
+                color_modes[image['/ColorSpace']], self.scale, jpeg_quality)
+
+
+# runs in worker processes; new (data, width, height, filter) or None when it would not be smaller
+def recompress(data, filter_name, width, height, mode, scale, quality):
+    target_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    if filter_name == '/DCTDecode':
+        image = Image.open(BytesIO(data))
+        if image.mode != mode:
+            return None
+        # jpeg decoder scales down by itself, much cheaper than decoding the full size
+        image.draft(mode, target_size)
+    else:
+        if target_size == (width, height):
+            return None
+        image = Image.frombytes(mode, (width, height), zlib.decompress(data))
+    if image.size != target_size:
+        image = image.resize(target_size, Image.LANCZOS)
+    if filter_name == '/DCTDecode':
+        buffer = BytesIO()
+        image.save(buffer, format='JPEG', quality=quality)
+        new_data = buffer.getvalue()
+        if target_size == (width, height) and len(new_data) > len(data) * (1 - min_jpeg_gain):
+            return None
+    else:
+        # everything but photos stays lossless
+        new_data = zlib.compress(image.tobytes(), 9)
+    if len(new_data) >= len(data):
+        return None
+    return new_data, image.width, image.height, filter_name
+
+
+def is_supported(image):
+    if image.get('/Subtype') != '/Image' or image.get('/ImageMask') or isinstance(image.get('/Mask'), ArrayObject):
+        return False
+    if image.get('/ColorSpace') not in list(color_modes) or image.get('/BitsPerComponent') != 8:
+        return False
+    if image.get('/Filter') == '/DCTDecode':
+        return True
+    return image.get('/Filter') == '/FlateDecode' and '/DecodeParms' not in image
+
+
+# images of the pages with the lowest resolution they may be shown at: an image drawn on a page is
+# never bigger than the page, so its real resolution is at least the one it would have covering it
+def find_images(pdf_reader, dpi):
+    jobs = {}
+    for i in range(pdf_reader.getNumPages()):
+        page = pdf_reader.getPage(i)
+        resources = page['/Resources'] if '/Resources' in page else {}
+        xobjects = resources['/XObject'] if '/XObject' in resources else {}
+        # inches
+        page_width = abs(float(page.mediaBox.getWidth())) / 72
+        page_height = abs(float(page.mediaBox.getHeight())) / 72
+        for name in xobjects:
+            image = xobjects[name]
+            if not is_supported(image) or not page_width or not page_height:
+                continue
+            ppi = max(int(image['/Width']) / page_width, int(image['/Height']) / page_height)
+            scale = min(1.0, dpi / ppi)
+            if id(image) in jobs:
+                jobs[id(image)].scale = max(jobs[id(image)].scale, scale)
+            else:
+                jobs[id(image)] = ImageJob(image, scale)
+    return jobs
+
+
+class ImageCopier(ObjectCopier):
+    """Copies a document, taking re-encoded images from a window of worker jobs running ahead of the writer."""
+
+    def __init__(self, writer, reader, jobs):
+        super().__init__(writer, reader)
+        self.jobs = jobs
+        self.pending = iter(list(jobs))
+        self.running = {}
+        self.ahead = max(1, image_converter.workers * 2)
+        self.replaced = 0
+
+    def submit(self, key):
+        arguments = self.jobs[key].arguments()
+        if image_converter.workers < 1:
+            self.running[key] = recompress(*arguments)
+        else:
+            self.running[key] = image_converter.get_pool().submit(recompress, *arguments)
+
+    def result(self, key):
+        # images are written in page order, the jobs are submitted in the same order
+        while key not in self.running or len(self.running) < self.ahead:
+            next_key = next(self.pending, None)
+            if next_key is None:
+                break
+            self.submit(next_key)
+        result = self.running.pop(key)
+        return result if image_converter.workers < 1 else result.result()
+
+    def stream_content(self, obj):
+        if id(obj) not in self.jobs:
+            return super().stream_content(obj)
+        result = self.result(id(obj))
+        if result is None:
+            return super().stream_content(obj)
+        self.replaced += 1
+        data, width, height, filter_name = result
+        replaced_keys = ('/Length', '/Width', '/Height', '/Filter', '/DecodeParms')
+        entries = [(key, value) for key, value in obj.items() if key not in replaced_keys]
+        return (self.serialize_entries(entries) + b'/Width %d/Height %d/Filter%s'
+                % (width, height, filter_name.encode('latin-1')), data)
+
+    def close(self):
+        for job in self.running.values():
+            if hasattr(job, 'cancel'):
+                job.cancel()
+
+
+def compress_images(file_path, output, dpi=None):
+    """Writes the document with its images re-encoded to the binary stream output."""
+    with open(file_path, 'rb') as input_file:
+        pdf_reader = PdfFileReader(input_file, strict=False)
+        if pdf_reader.isEncrypted:
+            pdf_reader.decrypt('')
+        jobs = find_images(pdf_reader, dpi or image_converter.target_dpi)
+        writer = StreamingPdfWriter(output)
+        copier = ImageCopier(writer, pdf_reader, jobs)
+        try:
+            copier.copy_pages([pdf_reader.getPage(i) for i in range(pdf_reader.getNumPages())])
+        finally:
+            copier.close()
+        writer.close()
+    return copier.replaced
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('input', help='Relative or absolute path of the input PDF file')
+    parser.add_argument('-c', '--compress', type=int, default=0, help='Ghostscript compression level from 0 to 4')
+    parser.add_argument('-d', '--dpi', type=float, default=image_converter.target_dpi,
+                        help='Resolution images are downsampled to')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count() or 1, help='Image worker processes')
+    args = parser.parse_args()
+
+    image_converter.configure(args.workers, args.dpi, image_converter.max_page_size)
+    size = os.path.getsize(args.input)
+    print('{:<12} {:>12} {:>8} {:>9}'.format('engine', 'bytes', 'ratio', 'seconds'))
+    print('{:<12} {:>12} {:>8.2f} {:>9}'.format('original', size, 1, '-'))
+
+    started = time.perf_counter()
+    output = BytesIO()
+    replaced = compress_images(args.input, output, args.dpi)
+    elapsed = time.perf_counter() - started
+    print('{:<12} {:>12} {:>8.2f} {:>9.2f}  {} image(s) replaced'.format(
+        'images', len(output.getvalue()), len(output.getvalue()) / size, elapsed, replaced))
+
+    started = time.perf_counter()
+    output = pdf_compressor.compress(args.input, '-', power=args.compress)
+    elapsed = time.perf_counter() - started
+    print('{:<12} {:>12} {:>8.2f} {:>9.2f}'.format(
+        'ghostscript', len(output), len(output) / size, elapsed))
+    image_converter.configure(0, args.dpi, image_converter.max_page_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+# convert images to pdf one image at a time, jpegs are embedded as they are
+import multiprocessing
+import threading
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+from app.tools.pdf_writer import StreamingPdfWriter, pdf_number
+
+# pixels per inch used to turn image size into page size
+resolution = 100.0
+chunk_size = 1024 * 1024
+
+# images are downsampled to target_dpi on pages no longer than max_page_size inches
+target_dpi = 150.0
+max_page_size = 11.69
+workers = 0
+pool = None
+pool_lock = threading.Lock()
+
+color_spaces = {'RGB': b'/DeviceRGB', 'L': b'/DeviceGray'}
+# phone cameras often write MPO: a jpeg followed by more jpeg frames, only the first one is used
+jpeg_formats = {'JPEG', 'MPO'}
+# exif orientations that are a plain rotation, the page is rotated instead of the pixels
+page_rotations = {1: 0, 3: 180, 6: 90, 8: 270}
+
+
+class PreparedImage:
+    """Image ready to be embedded: pixels are either a file to copy or already encoded bytes."""
+
+    def __init__(self, width, height, page_width, page_height, color_space, filter_name, rotate=0,
+                 file_path=None, data=None, length=None):
+        self.width = width
+        self.height = height
+        self.page_width = page_width
+        self.page_height = page_height
+        self.color_space = color_space
+        self.filter_name = filter_name
+        self.rotate = rotate
+        self.file_path = file_path
+        self.data = data
+        # bytes of the file to copy, all of them when None
+        self.length = length
+
+    def chunks(self):
+        if self.data is not None:
+            yield self.data
+            return
+        left = self.length
+        with open(self.file_path, 'rb') as file:
+            while left is None or left > 0:
+                chunk = file.read(chunk_size if left is None else min(chunk_size, left))
+                if not chunk:
+                    return
+                if left is not None:
+                    left -= len(chunk)
+                yield chunk
+
+
+# runs in worker processes, so settings come as arguments
+def prepare_image(file_path, dpi, page_size):
+    with Image.open(file_path) as image:
+        orientation = image.getexif().get(0x0112, 1)
+        # inches per pixel: the usual resolution, unless the page would get longer than page_size
+        page_scale = min(1.0 / resolution, page_size / max(image.size))
+        scale = min(1.0, page_scale * dpi)
+        passthrough = image.format in jpeg_formats and image.mode in color_spaces and orientation in page_rotations
+        if passthrough and scale == 1.0:
+            return PreparedImage(image.width, image.height, image.width * page_scale * 72,
+                                 image.height * page_scale * 72, color_spaces[image.mode], b'/DCTDecode',
+                                 rotate=page_rotations[orientation], file_path=file_path,
+                                 length=first_frame_length(image))
+        return transcode(image, page_scale, scale)
+
+
+# bytes of the first jpeg of an MPO file, None for plain jpegs
+def first_frame_length(image):
+    if image.format != 'MPO':
+        return None
+    try:
+        return image.mpinfo[0xB002][0]['Size']
+    except (AttributeError, IndexError, KeyError, TypeError):
+        return None
+
+
+# images pdf cannot embed directly or too big ones get here; photos are re-encoded as jpeg, everything else losslessly
+def transcode(image, page_scale, scale):
+    photo = image.format in jpeg_formats
+    transposed = image.getexif().get(0x0112, 1) in (5, 6, 7, 8)
+    width, height = (image.height, image.width) if transposed else image.size
+    page_width, page_height = width * page_scale * 72, height * page_scale * 72
+    target_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    if scale < 1.0 and photo:
+        # jpeg decoder scales down by itself, much cheaper than decoding the full size
+        image.draft(image.mode, target_size[::-1] if transposed else target_size)
+    image = ImageOps.exif_transpose(image)
+    image = image.convert('L' if image.mode in ('1', 'L') else 'RGB')
+    if image.size != target_size:
+        image = image.resize(target_size, Image.LANCZOS)
+    if photo:
+        buffer = BytesIO()
+        image.save(buffer, format='JPEG', quality=85)
+        return PreparedImage(image.width, image.height, page_width, page_height, color_spaces[image.mode],
+                             b'/DCTDecode', data=buffer.getvalue())
+    compressor = zlib.compressobj(6)
+    parts = []
+    rows = max(1, chunk_size // (image.width * len(image.mode)))
+    for top in range(0, image.height, rows):
+        parts.append(compressor.compress(image.crop((0, top, image.width, min(top + rows, image.height))).tobytes()))
+    parts.append(compressor.flush())
+    return PreparedImage(image.width, image.height, page_width, page_height, color_spaces[image.mode],
+                         b'/FlateDecode', data=b''.join(parts))
+
+
+def add_image_page(writer, prepared):
+    image_num = writer.allocate()
+    writer.write_stream_chunks(
+        image_num,
+        b'/Type/XObject/Subtype/Image/Width %d/Height %d/ColorSpace%s/BitsPerComponent 8/Filter%s'
+        % (prepared.width, prepared.height, prepared.color_space, prepared.filter_name),
+        prepared.chunks()
+    )
+    width = pdf_number(prepared.page_width)
+    height = pdf_number(prepared.page_height)
+    content_num = writer.allocate()
+    writer.write_stream(content_num, b'', b'q %s 0 0 %s 0 0 cm /Im0 Do Q' % (width, height))
+    page_num = writer.allocate()
+    writer.write_object(page_num, b'<</Type/Page/Parent %d 0 R/MediaBox[0 0 %s %s]/Rotate %d'
+                                  b'/Resources<</XObject<</Im0 %d 0 R>>>>/Contents %d 0 R>>'
+                        % (writer.pages_num, width, height, prepared.rotate, image_num, content_num))
+    writer.add_page(page_num)
+
+
+def configure(image_workers, dpi, page_size):
+    global workers, target_dpi, max_page_size, pool
+    workers, target_dpi, max_page_size = image_workers, dpi, page_size
+    with pool_lock:
+        if pool is not None:
+            pool.shutdown(wait=False)
+            pool = None
+
+
+def get_pool():
+    global pool
+    with pool_lock:
+        if pool is None:
+            # forkserver keeps workers away from the threads and sockets of the bot process
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('forkserver'))
+        return pool
+
+
+# images are decoded in worker processes; a small window of them runs ahead of the writer,
+# so memory use is bounded by a few images, not by the number of images
+def prepared_images(list_of_files):
+    if workers < 1 or len(list_of_files) < 2:
+        for file_path in list_of_files:
+            yield prepare_image(file_path, target_dpi, max_page_size)
+        return
+    window = []
+    files = iter(list_of_files)
+    for file_path in files:
+        window.append(get_pool().submit(prepare_image, file_path, target_dpi, max_page_size))
+        if len(window) >= workers * 2:
+            break
+    try:
+        while window:
+            prepared = window.pop(0).result()
+            file_path = next(files, None)
+            if file_path is not None:
+                window.append(get_pool().submit(prepare_image, file_path, target_dpi, max_page_size))
+            yield prepared
+    finally:
+        for job in window:
+            job.cancel()
+
+
+def images_to_pdf(list_of_files, output_path):
+    with open(output_path, 'wb') as output:
+        writer = StreamingPdfWriter(output)
+        for prepared in prepared_images(list_of_files):
+            add_image_page(writer, prepared)
+        writer.close()
+    return output_path
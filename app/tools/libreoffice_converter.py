@@ -15,12 +15,13 @@ sudo apt install libreoffice
 """
 
 import argparse
-import subprocess
 import os.path
 import sys
 
+from app.tools import supervisor
 
-def convert(conversion_type, input_file_path, output_dir):
+
+def convert(conversion_type, input_file_path, output_dir, profile=None):
     export_type = {
         'doc2pdf': 'pdf:writer_pdf_Export',
         'ppt2pdf': 'pdf:impress_pdf_Export',
@@ -37,8 +38,10 @@ def convert(conversion_type, input_file_path, output_dir):
         raise Exception("Error: Filetype is not supported")
         sys.exit(1)
 
-    subprocess.call(['libreoffice', '--headless', '--convert-to', export_type[conversion_type],
-                     input_file_path, '--outdir', output_dir]
+    # libreoffice running with the same profile takes the file over and exits without converting it
+    profile_option = ['-env:UserInstallation={}'.format(profile)] if profile is not None else []
+    supervisor.run(['libreoffice', '--headless'] + profile_option + ['--convert-to', export_type[conversion_type],
+                    input_file_path, '--outdir', output_dir]
     )
     
 
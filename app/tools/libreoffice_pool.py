@@ -0,0 +1,216 @@
+"""
+Pool of long-lived headless LibreOffice instances driven over UNO.
+
+Every instance runs with its own user profile, so several of them can convert documents at the same time.
+An instance is checked before each job, restarted when it crashed and recycled after a number of jobs.
+Processes converting on one machine, like several workers, each claim a slot that gives them their own
+ports and profiles.
+
+Dependency: Libreoffice with python UNO bridge.
+
+On Linux install via command line:
+sudo apt install libreoffice python3-uno
+"""
+
+import fcntl
+import functools
+import itertools
+import logging
+import os
+import pathlib
+import queue
+import signal
+import subprocess
+import time
+
+try:
+    import uno
+    from com.sun.star.beans import PropertyValue
+except ImportError:
+    uno = None
+
+from app.tools import supervisor
+
+logger = logging.getLogger(__name__)
+
+export_filters = {
+    'doc2pdf': 'writer_pdf_Export',
+    'ppt2pdf': 'impress_pdf_Export',
+}
+
+
+def _property(name, value):
+    prop = PropertyValue()
+    prop.Name = name
+    prop.Value = value
+    return prop
+
+
+class OfficeInstance:
+    def __init__(self, port, profile_dir, startup_timeout=30):
+        self.port = port
+        self.profile_dir = profile_dir
+        self.startup_timeout = startup_timeout
+        self.process = None
+        self.desktop = None
+        self.jobs = 0
+
+    def start(self):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        self.process = subprocess.Popen(
+            ['soffice', '--headless', '--invisible', '--nologo', '--norestore', '--nodefault', '--nolockcheck',
+             '-env:UserInstallation={}'.format(pathlib.Path(os.path.abspath(self.profile_dir)).as_uri()),
+             '--accept=socket,host=127.0.0.1,port={};urp;StarOffice.ComponentContext'.format(self.port)],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True
+        )
+        # instances live for many jobs, so only their memory is capped, not the cpu time they add up
+        supervisor.apply_limits(self.process.pid, cpu=False)
+        deadline = time.monotonic() + self.startup_timeout
+        while True:
+            try:
+                self.desktop = self._connect()
+                break
+            except Exception:
+                if self.process.poll() is not None or time.monotonic() > deadline:
+                    self.stop()
+                    raise Exception("Error: LibreOffice instance on port {} did not start".format(self.port))
+                time.sleep(0.25)
+        self.jobs = 0
+        logger.info('LibreOffice instance on port %s started (pid %s)', self.port, self.process.pid)
+
+    def _connect(self):
+        local_context = uno.getComponentContext()
+        resolver = local_context.ServiceManager.createInstanceWithContext(
+            'com.sun.star.bridge.UnoUrlResolver', local_context)
+        context = resolver.resolve(
+            'uno:socket,host=127.0.0.1,port={};urp;StarOffice.ComponentContext'.format(self.port))
+        return context.ServiceManager.createInstanceWithContext('com.sun.star.frame.Desktop', context)
+
+    def is_healthy(self):
+        if self.process is None or self.process.poll() is not None or self.desktop is None:
+            return False
+        try:
+            self.desktop.getComponents()
+            return True
+        except Exception:
+            return False
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            self.process.wait()
+        self.process = None
+        self.desktop = None
+
+    def restart(self):
+        self.stop()
+        self.start()
+
+    def convert(self, conversion_type, input_file_path, output_dir):
+        fname = os.path.basename(input_file_path)
+        output_path = os.path.join(output_dir, '{}.pdf'.format(''.join(fname.split('.')[:-1])))
+        document = self.desktop.loadComponentFromURL(
+            uno.systemPathToFileUrl(os.path.abspath(input_file_path)), '_blank', 0,
+            (_property('Hidden', True),))
+        try:
+            document.storeToURL(uno.systemPathToFileUrl(os.path.abspath(output_path)),
+                                (_property('FilterName', export_filters[conversion_type]),))
+        finally:
+            document.close(True)
+        self.jobs += 1
+        return output_path
+
+
+class OfficePool:
+    def __init__(self, size, max_jobs=50, base_port=2002, profile_root=os.path.join('temp', 'libreoffice')):
+        self.size = size
+        self.max_jobs = max_jobs
+        self.idle = queue.Queue()
+        for n in range(size):
+            self.idle.put(OfficeInstance(base_port + n, os.path.join(profile_root, 'instance_{}'.format(n))))
+
+    def convert(self, conversion_type, input_file_path, output_dir):
+        instance = self.idle.get()
+        try:
+            if instance.process is None:
+                instance.start()
+            elif not instance.is_healthy():
+                logger.warning('LibreOffice instance on port %s is not healthy, restarting', instance.port)
+                instance.restart()
+            # a hung or cancelled conversion is stopped by killing its instance
+            guard = supervisor.Guard(functools.partial(supervisor.kill_group, instance.process))
+            try:
+                with guard:
+                    return instance.convert(conversion_type, input_file_path, output_dir)
+            except Exception as error:
+                # a failed conversion may leave the instance in a broken state
+                if not instance.is_healthy():
+                    instance.stop()
+                if guard.reason == 'timeout':
+                    raise supervisor.ToolTimeout('LibreOffice conversion timed out') from error
+                if guard.reason == 'cancel':
+                    raise supervisor.ToolCancelled('LibreOffice conversion was cancelled') from error
+                raise
+            finally:
+                if instance.jobs >= self.max_jobs:
+                    logger.info('LibreOffice instance on port %s served %s jobs, recycling',
+                                instance.port, instance.jobs)
+                    instance.stop()
+        finally:
+            self.idle.put(instance)
+
+    def close(self):
+        for _ in range(self.size):
+            self.idle.get().stop()
+
+
+pool = None
+profile_root = os.path.join('temp', 'libreoffice')
+# index of this process among the ones converting on this machine and the lock file that holds it
+slot = None
+slot_lock = None
+
+
+# the first slot no other process holds, the lock goes away with the process
+def claim_slot():
+    global slot, slot_lock
+    if slot is None:
+        os.makedirs(profile_root, exist_ok=True)
+        for index in itertools.count():
+            lock_file = open(os.path.join(profile_root, 'slot_{}.lock'.format(index)), 'a')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                continue
+            slot, slot_lock = index, lock_file
+            logger.info('LibreOffice slot %d is taken', slot)
+            break
+    return slot
+
+
+# profile of cold started libreoffice, one per process so they do not hand files over to each other
+def cold_profile():
+    return pathlib.Path(os.path.abspath(os.path.join(profile_root, 'slot_{}'.format(claim_slot()), 'cold'))).as_uri()
+
+
+# start using warm instances, size 0 or missing UNO bridge keep cold starts per file
+def configure(size, max_jobs, base_port):
+    global pool
+    close()
+    if size > 0 and uno is None:
+        logger.warning('Python UNO bridge is not available, LibreOffice is started for every file')
+    elif size > 0:
+        index = claim_slot()
+        pool = OfficePool(size, max_jobs=max_jobs, base_port=base_port + index * size,
+                          profile_root=os.path.join(profile_root, 'slot_{}'.format(index)))
+
+
+def close():
+    global pool
+    if pool is not None:
+        pool.close()
+        pool = None
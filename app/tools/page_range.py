@@ -0,0 +1,83 @@
+# page selections like "1-3, 5, 7-" kept as sorted merged intervals instead of page lists
+import bisect
+import re
+
+LAST_PAGE = r'last|end|последняя|конец'
+PART = re.compile(r'^\s*(?:(\d+|{0})?\s*[-:]\s*(\d+|{0})?|(\d+|{0}))\s*$'.format(LAST_PAGE), re.IGNORECASE)
+
+
+class PageSelection:
+    """Pages selected by the user, 1-based inclusive intervals sorted and merged."""
+
+    def __init__(self, intervals, truncated=False):
+        self.intervals = [list(interval) for interval in intervals]
+        self.starts = [start for start, _ in self.intervals]
+        self.truncated = truncated
+
+    # "a", "a-b", "b-a", "a-", "-b", "last", "a-last"; pages outside the document are cut off
+    @classmethod
+    def parse(cls, text, num_of_pages):
+        intervals = []
+        truncated = False
+        for part in text.split(','):
+            match = PART.match(part)
+            if match is None:
+                raise ValueError('unsupported page pattern: {}'.format(part.strip()))
+            first, last, single = match.groups()
+            if single is not None:
+                first = last = page_number(single, num_of_pages)
+            else:
+                if first is None and last is None:
+                    raise ValueError('empty page interval')
+                open_interval = first is None or last is None
+                first = page_number(first, num_of_pages) if first is not None else 1
+                last = page_number(last, num_of_pages) if last is not None else num_of_pages
+                # "9-4" is read as a reversed range, "11-" of a 10 page document selects nothing
+                if first > last and not open_interval:
+                    first, last = last, first
+            if first < 1 or last > num_of_pages or first > last:
+                truncated = True
+                first, last = max(first, 1), min(last, num_of_pages)
+                if first > last:
+                    continue
+            intervals.append((first, last))
+        return cls(merge_intervals(intervals), truncated)
+
+    def __contains__(self, page):
+        i = bisect.bisect_right(self.starts, page) - 1
+        return i >= 0 and page <= self.intervals[i][1]
+
+    def __iter__(self):
+        for first, last in self.intervals:
+            yield from range(first, last + 1)
+
+    def __len__(self):
+        return sum(last - first + 1 for first, last in self.intervals)
+
+    # pages of the document that are not selected, as intervals
+    def complement(self, num_of_pages):
+        result = []
+        page = 1
+        for first, last in self.intervals:
+            if first > page:
+                result.append([page, first - 1])
+            page = last + 1
+        if page <= num_of_pages:
+            result.append([page, num_of_pages])
+        return PageSelection(result)
+
+
+def page_number(token, num_of_pages):
+    if token.isdigit():
+        return int(token)
+    return num_of_pages
+
+
+def merge_intervals(intervals):
+    merged = []
+    for first, last in sorted(intervals):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], last)
+        else:
+            merged.append([first, last])
+    return merged
@@ -0,0 +1,137 @@
+# one pdf per page, each carrying only the resources its content refers to; pages are
+# rendered in worker processes, each keeping its own parsed copy of the document
+import math
+import multiprocessing
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+from PyPDF2.generic import ArrayObject, DictionaryObject, NameObject
+from PyPDF2.pdf import PageObject
+
+from app.tools.pdf_writer import ObjectCopier, StreamingPdfWriter
+from app.tools.reader_cache import ReaderCache
+
+NAME = re.compile(rb'/[^\s/\[\]()<>{}%]*')
+# resource dictionaries addressed by name from content streams
+named_resources = {'/XObject', '/Font', '/ExtGState', '/ColorSpace', '/Pattern', '/Shading', '/Properties'}
+max_chunk_pages = 64
+# shorter splits are done in the calling thread, starting the workers would cost more
+min_parallel_pages = 32
+
+workers = 0
+pool = None
+pool_lock = threading.Lock()
+# readers of worker processes, documents of finished jobs are pushed out by the next ones
+worker_readers = ReaderCache(max_entries=2)
+
+
+# names used in a content stream; a name used as anything else only keeps a resource
+# that was not needed, a used resource is never dropped
+def content_names(contents):
+    contents = contents.getObject()
+    if isinstance(contents, ArrayObject):
+        data = b'\n'.join(part.getObject().getData() for part in contents)
+    else:
+        data = contents.getData()
+    return {name.decode('latin-1') for name in NAME.findall(data)}
+
+
+def used_names(page, resources):
+    names = content_names(page['/Contents'])
+    xobjects = resources.get('/XObject')
+    xobjects = xobjects.getObject() if xobjects is not None else {}
+    # forms without resources of their own use the ones of the page
+    forms = [name for name in names if name in xobjects]
+    while forms:
+        form = xobjects[forms.pop()].getObject()
+        if form.get('/Subtype') == '/Form' and '/Resources' not in form:
+            new_names = content_names(form) - names
+            names |= new_names
+            forms.extend(name for name in new_names if name in xobjects)
+    return names
+
+
+def pruned_page(reader, page):
+    resources = page.get('/Resources')
+    if resources is None or '/Contents' not in page:
+        return page
+    resources = resources.getObject()
+    try:
+        names = used_names(page, resources)
+    except Exception:
+        # content with a filter PyPDF2 cannot decode keeps all its resources
+        return page
+    pruned = DictionaryObject()
+    for category, entries in resources.items():
+        entries_object = entries.getObject()
+        if category in named_resources and isinstance(entries_object, DictionaryObject):
+            pruned[category] = DictionaryObject(
+                (name, value) for name, value in entries_object.items() if name in names)
+        else:
+            pruned[category] = entries
+    result = PageObject(reader, page.indirectRef)
+    result.update(page)
+    result[NameObject('/Resources')] = pruned
+    return result
+
+
+def page_pdf(reader, page_number):
+    output = BytesIO()
+    writer = StreamingPdfWriter(output)
+    ObjectCopier(writer, reader).copy_pages([pruned_page(reader, reader.getPage(page_number - 1))])
+    writer.close()
+    return output.getvalue()
+
+
+# runs in worker processes
+def render_pages(file_path, page_numbers):
+    reader = worker_readers.get(file_path)
+    return [page_pdf(reader, page_number) for page_number in page_numbers]
+
+
+def configure(split_workers):
+    global workers, pool
+    workers = split_workers
+    with pool_lock:
+        if pool is not None:
+            pool.shutdown(wait=False)
+            pool = None
+
+
+def get_pool():
+    global pool
+    with pool_lock:
+        if pool is None:
+            # forkserver keeps workers away from the threads and sockets of the bot process
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('forkserver'))
+        return pool
+
+
+# (page number, pdf bytes) in page order; chunks are sized so every worker parses the
+# document once and gets a few chunks, while only a window of them is held in memory
+def split_pages(reader, file_path, page_numbers):
+    page_numbers = list(page_numbers)
+    if workers < 1 or len(page_numbers) < min_parallel_pages:
+        for page_number in page_numbers:
+            yield page_number, page_pdf(reader, page_number)
+        return
+    chunk_pages = min(max_chunk_pages, math.ceil(len(page_numbers) / (workers * 4)))
+    chunks = iter([page_numbers[i:i + chunk_pages] for i in range(0, len(page_numbers), chunk_pages)])
+    window = []
+    for chunk in chunks:
+        window.append((chunk, get_pool().submit(render_pages, file_path, chunk)))
+        if len(window) >= workers * 2:
+            break
+    try:
+        while window:
+            chunk, job = window.pop(0)
+            documents = job.result()
+            next_chunk = next(chunks, None)
+            if next_chunk is not None:
+                window.append((next_chunk, get_pool().submit(render_pages, file_path, next_chunk)))
+            yield from zip(chunk, documents)
+    finally:
+        for _, job in window:
+            job.cancel()
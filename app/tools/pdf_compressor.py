@@ -23,17 +23,25 @@ import os.path
 import sys
 from shutil import copyfile
 
+from app.tools import supervisor
 
-def compress(input_file_path, output_file_path, power=0):
-    """Function to compress PDF via Ghostscript command line interface"""
-    quality = {
-        0: '/default',
-        1: '/prepress',
-        2: '/printer',
-        3: '/ebook',
-        4: '/screen'
-    }
 
+quality = {
+    0: '/default',
+    1: '/prepress',
+    2: '/printer',
+    3: '/ebook',
+    4: '/screen'
+}
+
+
+def compress(input_file_path, output_file_path, power=0, first_page=None, last_page=None):
+    """Function to compress PDF via Ghostscript command line interface.
+
+    With output_file_path '-' the compressed PDF is returned as bytes instead of being written to a file.
+    first_page and last_page limit the output to a page range of the input.
+    Ghostscript runs under app.tools.supervisor, failures raise supervisor.ToolError.
+    """
     # Basic controls
     # Check if valid path
     if not os.path.isfile(input_file_path):
@@ -45,12 +53,25 @@ def compress(input_file_path, output_file_path, power=0):
         print("Error: input file is not a PDF")
         sys.exit(1)
 
-    subprocess.call(['gs', '-sDEVICE=pdfwrite', '-dCompatibilityLevel=1.4',
-                    '-dPDFSETTINGS={}'.format(quality[power]),
-                    '-dNOPAUSE', '-dQUIET', '-dBATCH',
-                    '-sOutputFile={}'.format(output_file_path),
-                     input_file_path]
-    )
+    command = build_command(input_file_path, output_file_path, power, first_page, last_page)
+
+    return supervisor.run(command, capture_output=output_file_path == '-')
+
+
+def build_command(input_file_path, output_file_path, power=0, first_page=None, last_page=None):
+    command = ['gs', '-sDEVICE=pdfwrite', '-dCompatibilityLevel=1.4',
+               '-dPDFSETTINGS={}'.format(quality[power]),
+               '-dNOPAUSE', '-dQUIET', '-dBATCH',
+               '-sOutputFile={}'.format(output_file_path),
+               input_file_path]
+    if first_page is not None:
+        command.insert(1, '-dFirstPage={}'.format(first_page))
+    if last_page is not None:
+        command.insert(1, '-dLastPage={}'.format(last_page))
+    if output_file_path == '-':
+        # keep ghostscript messages out of the document stream
+        command.insert(1, '-sstdout=%stderr')
+    return command
 
 
 def main():
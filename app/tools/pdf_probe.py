@@ -0,0 +1,335 @@
+"""
+Lightweight PDF probe that reads the page count without parsing the whole document.
+
+Only the trailer, the cross-reference sections (tables or streams, following /Prev chains),
+the document catalog and the page tree root are read. Anything unexpected raises ProbeError,
+so callers can fall back to a full parser.
+"""
+
+import re
+import zlib
+
+
+class ProbeError(Exception):
+    pass
+
+
+class Name(str):
+    pass
+
+
+class Ref:
+    def __init__(self, num, gen):
+        self.num = num
+        self.gen = gen
+
+
+WHITESPACE = b' \t\r\n\x0c\x00'
+DELIMITERS = b'()<>[]{}/%'
+NUMBER = re.compile(rb'[+-]?(\d+\.?\d*|\.\d+)')
+REF = re.compile(rb'(\d+)\s+(\d+)\s+R')
+OBJ = re.compile(rb'\s*(\d+)\s+(\d+)\s+obj')
+STARTXREF = re.compile(rb'startxref\s+(\d+)')
+SUBSECTION = re.compile(rb'\s*(\d+)\s+(\d+)\s*?(\r\n|\r|\n| \r| \n)')
+
+
+class Parser:
+    """Parses PDF objects from a bytes buffer, runs off the end with IndexError."""
+
+    def __init__(self, data, pos=0, complete=True):
+        self.data = data
+        self.pos = pos
+        self.complete = complete
+
+    def skip_whitespace(self):
+        data = self.data
+        while self.pos < len(data):
+            if data[self.pos] in WHITESPACE:
+                self.pos += 1
+            elif data[self.pos] == ord('%'):
+                while self.pos < len(data) and data[self.pos] not in b'\r\n':
+                    self.pos += 1
+            else:
+                return
+        raise IndexError('end of buffer')
+
+    def parse(self):
+        self.skip_whitespace()
+        data = self.data
+        char = data[self.pos]
+        if data.startswith(b'<<', self.pos):
+            self.pos += 2
+            result = {}
+            while True:
+                self.skip_whitespace()
+                if data.startswith(b'>>', self.pos):
+                    self.pos += 2
+                    return result
+                key = self.parse()
+                if not isinstance(key, Name):
+                    raise ProbeError('dictionary key is not a name')
+                result[key] = self.parse()
+        if char == ord('['):
+            self.pos += 1
+            result = []
+            while True:
+                self.skip_whitespace()
+                if data[self.pos] == ord(']'):
+                    self.pos += 1
+                    return result
+                result.append(self.parse())
+        if char == ord('/'):
+            end = self.pos + 1
+            while data[end] not in WHITESPACE and data[end] not in DELIMITERS:
+                end += 1
+            name = Name(data[self.pos + 1:end].decode('latin-1'))
+            self.pos = end
+            return name
+        if char == ord('<'):
+            end = data.index(b'>', self.pos)
+            value = data[self.pos + 1:end]
+            self.pos = end + 1
+            return value
+        if char == ord('('):
+            return self.parse_string()
+        if not self.complete and len(data) - self.pos < 32:
+            raise IndexError('reference may continue past the buffer')
+        match = REF.match(data, self.pos)
+        if match:
+            self.pos = match.end()
+            return Ref(int(match.group(1)), int(match.group(2)))
+        match = NUMBER.match(data, self.pos)
+        if match:
+            self.pos = match.end()
+            text = match.group(0)
+            return float(text) if b'.' in text else int(text)
+        for keyword, value in ((b'true', True), (b'false', False), (b'null', None)):
+            if data.startswith(keyword, self.pos):
+                self.pos += len(keyword)
+                return value
+        raise ProbeError('unexpected token at {}'.format(self.pos))
+
+    def parse_string(self):
+        data = self.data
+        depth = 0
+        start = self.pos
+        while True:
+            char = data[self.pos]
+            if char == ord('\\'):
+                self.pos += 2
+                continue
+            if char == ord('('):
+                depth += 1
+            elif char == ord(')'):
+                depth -= 1
+                if depth == 0:
+                    self.pos += 1
+                    return data[start + 1:self.pos - 1]
+            self.pos += 1
+
+
+class Probe:
+    def __init__(self, file):
+        self.file = file
+        self.file.seek(0, 2)
+        self.size = self.file.tell()
+        self.sections = []
+        self.trailer = None
+        self.object_streams = {}
+
+    def read(self, offset, length):
+        self.file.seek(offset)
+        return self.file.read(length)
+
+    # parse an object at offset, reading more of the file while the object does not fit
+    def parse_at(self, offset, length=4096):
+        while True:
+            data = self.read(offset, length)
+            try:
+                parser = Parser(data, complete=offset + len(data) >= self.size)
+                match = OBJ.match(data)
+                if match:
+                    parser.pos = match.end()
+                value = parser.parse()
+                return match, value, parser, data
+            except IndexError:
+                if offset + length >= self.size:
+                    raise ProbeError('object at {} is truncated'.format(offset))
+                length *= 4
+
+    def load(self):
+        tail = self.read(max(0, self.size - 2048), 2048)
+        positions = list(STARTXREF.finditer(tail))
+        if not positions:
+            raise ProbeError('startxref is not found')
+        offset = int(positions[-1].group(1))
+        visited = set()
+        while offset is not None:
+            if offset in visited or offset >= self.size:
+                raise ProbeError('broken xref chain')
+            visited.add(offset)
+            section, trailer = self.load_section(offset)
+            self.sections.append(section)
+            if self.trailer is None:
+                self.trailer = trailer
+            # hybrid files keep compressed objects in an extra xref stream
+            if isinstance(trailer.get('XRefStm'), int):
+                self.sections.append(self.load_section(trailer['XRefStm'])[0])
+            offset = trailer.get('Prev')
+            if offset is not None and not isinstance(offset, int):
+                raise ProbeError('bad /Prev')
+
+    def load_section(self, offset):
+        head = self.read(offset, 4)
+        if head == b'xref':
+            return self.load_table(offset)
+        return self.load_stream(offset)
+
+    # classic xref table, entries are located by arithmetic on 20-byte lines
+    def load_table(self, offset):
+        section = []
+        pos = offset + 4
+        while True:
+            chunk = self.read(pos, 64)
+            match = SUBSECTION.match(chunk)
+            if not match:
+                break
+            start, count = int(match.group(1)), int(match.group(2))
+            section.append(('table', start, count, pos + match.end()))
+            pos += match.end() + 20 * count
+        chunk = self.read(pos, 32)
+        trailer_at = chunk.find(b'trailer')
+        if trailer_at < 0:
+            raise ProbeError('trailer is not found')
+        _, trailer, _, _ = self.parse_at(pos + trailer_at + len(b'trailer'))
+        return section, trailer
+
+    def load_stream(self, offset):
+        match, stream_dict, parser, data = self.parse_at(offset)
+        if not match or stream_dict.get('Type') != 'XRef':
+            raise ProbeError('xref stream is expected at {}'.format(offset))
+        content = self.stream_content(offset, stream_dict, parser, data)
+        widths = stream_dict['W']
+        index = stream_dict.get('Index', [0, stream_dict['Size']])
+        entry_size = sum(widths)
+        section = []
+        row = 0
+        for start, count in zip(index[0::2], index[1::2]):
+            section.append(('stream', start, count, (content, widths, row * entry_size)))
+            row += count
+        return section, stream_dict
+
+    def stream_content(self, offset, stream_dict, parser, data):
+        length = stream_dict.get('Length')
+        if not isinstance(length, int):
+            raise ProbeError('stream length is not direct')
+        pos = data.index(b'stream', parser.pos) + len(b'stream')
+        if data[pos:pos + 2] == b'\r\n':
+            pos += 2
+        elif data[pos:pos + 1] in (b'\n', b'\r'):
+            pos += 1
+        content = self.read(offset + pos, length)
+        filters = stream_dict.get('Filter')
+        if filters is None:
+            return content
+        if isinstance(filters, list):
+            if len(filters) != 1:
+                raise ProbeError('filter chains are not supported')
+            filters = filters[0]
+        if filters != 'FlateDecode':
+            raise ProbeError('unsupported filter {}'.format(filters))
+        content = zlib.decompress(content)
+        params = stream_dict.get('DecodeParms') or {}
+        if isinstance(params, list):
+            params = params[0] or {}
+        predictor = params.get('Predictor', 1)
+        if predictor >= 10:
+            content = png_unpredict(content, params.get('Columns', 1))
+        elif predictor != 1:
+            raise ProbeError('unsupported predictor {}'.format(predictor))
+        return content
+
+    def locate(self, num):
+        for section in self.sections:
+            for kind, start, count, where in section:
+                if not start <= num < start + count:
+                    continue
+                if kind == 'table':
+                    line = self.read(where + 20 * (num - start), 20)
+                    if len(line) < 18 or line[10:11] != b' ' or line[16:17] != b' ' or line[17:18] not in b'nf':
+                        raise ProbeError('malformed xref table entry')
+                    if line[17:18] == b'f':
+                        return None
+                    return 1, int(line[:10]), 0
+                content, widths, base = where
+                pos = base + sum(widths) * (num - start)
+                fields = []
+                for width in widths:
+                    fields.append(int.from_bytes(content[pos:pos + width], 'big'))
+                    pos += width
+                entry_type = fields[0] if widths[0] else 1
+                if entry_type == 0:
+                    return None
+                return entry_type, fields[1], fields[2]
+        return None
+
+    def resolve(self, value):
+        if not isinstance(value, Ref):
+            return value
+        entry = self.locate(value.num)
+        if entry is None:
+            raise ProbeError('object {} is not found'.format(value.num))
+        entry_type, first, second = entry
+        if entry_type == 1:
+            match, obj, _, _ = self.parse_at(first)
+            if not match or int(match.group(1)) != value.num:
+                raise ProbeError('object {} is not at its xref offset'.format(value.num))
+            return obj
+        if entry_type == 2:
+            return self.from_object_stream(first, second)
+        raise ProbeError('unknown xref entry type')
+
+    def from_object_stream(self, stream_num, index):
+        if stream_num not in self.object_streams:
+            entry = self.locate(stream_num)
+            if entry is None or entry[0] != 1:
+                raise ProbeError('object stream {} is not found'.format(stream_num))
+            match, stream_dict, parser, data = self.parse_at(entry[1])
+            self.object_streams[stream_num] = (stream_dict,
+                                               self.stream_content(entry[1], stream_dict, parser, data))
+        stream_dict, content = self.object_streams[stream_num]
+        header = Parser(content[:stream_dict['First']] + b' ')
+        offsets = []
+        for _ in range(stream_dict['N']):
+            header.parse()
+            offsets.append(header.parse())
+        return Parser(content + b' ', stream_dict['First'] + offsets[index]).parse()
+
+
+def png_unpredict(data, columns):
+    rows = []
+    previous = bytearray(columns)
+    row_size = columns + 1
+    for pos in range(0, len(data), row_size):
+        kind = data[pos]
+        row = bytearray(data[pos + 1:pos + row_size])
+        if kind == 2:
+            for i in range(len(row)):
+                row[i] = (row[i] + previous[i]) & 0xff
+        elif kind != 0:
+            raise ProbeError('unsupported png predictor row type {}'.format(kind))
+        rows.append(bytes(row))
+        previous = row
+    return b''.join(rows)
+
+
+def count_pages(file_path):
+    with open(file_path, 'rb') as file:
+        probe = Probe(file)
+        probe.load()
+        catalog = probe.resolve(probe.trailer.get('Root'))
+        pages = probe.resolve(catalog['Pages'])
+        count = probe.resolve(pages['Count'])
+        if not isinstance(count, int) or count < 0:
+            raise ProbeError('bad page count')
+        return count
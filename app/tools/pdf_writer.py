@@ -0,0 +1,408 @@
+# minimal pdf writer that puts every object to the output as soon as it is ready
+import hashlib
+import logging
+from io import BytesIO
+
+from PyPDF2 import PdfFileReader
+from PyPDF2.generic import ArrayObject, DictionaryObject, IndirectObject, StreamObject
+
+logger = logging.getLogger(__name__)
+
+PDF_HEADER = b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n'
+# besides streams, dictionaries of these types are shared between documents when identical
+shared_types = {'/Font', '/FontDescriptor', '/ExtGState'}
+max_digest_depth = 64
+
+
+class StreamingPdfWriter:
+    """Writes a PDF object by object.
+
+    Only object offsets, page object numbers, outline items and named destinations are kept
+    in memory, the page tree, outline, names, catalog and cross-reference table are written by close().
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.position = 0
+        self.offsets = [None]
+        self.pages = []
+        self.outline = []
+        # serialized name -> destination of the catalog /Dests, the first document giving a name wins
+        self.dest_names = {}
+        # raw string -> (serialized string, destination) of the /Dests name tree
+        self.dest_strings = {}
+        self.info = None
+        self.write(PDF_HEADER)
+        self.pages_num = self.allocate()
+
+    def write(self, data):
+        self.stream.write(data)
+        self.position += len(data)
+
+    def allocate(self):
+        self.offsets.append(None)
+        return len(self.offsets) - 1
+
+    def write_object(self, num, body):
+        self.offsets[num] = self.position
+        self.write(b'%d 0 obj\n' % num)
+        self.write(body)
+        self.write(b'\nendobj\n')
+
+    # entries are the serialized dictionary content without << >> and /Length
+    def write_stream(self, num, entries, data):
+        self.offsets[num] = self.position
+        self.write(b'%d 0 obj\n<<%s/Length %d>>\nstream\n' % (num, entries, len(data)))
+        self.write(data)
+        self.write(b'\nendstream\nendobj\n')
+
+    # stream of unknown size copied from chunks, its length goes to a separate object
+    def write_stream_chunks(self, num, entries, chunks):
+        length_num = self.allocate()
+        self.offsets[num] = self.position
+        self.write(b'%d 0 obj\n<<%s/Length %d 0 R>>\nstream\n' % (num, entries, length_num))
+        start = self.position
+        for chunk in chunks:
+            self.write(chunk)
+        length = self.position - start
+        self.write(b'\nendstream\nendobj\n')
+        self.write_object(length_num, b'%d' % length)
+
+    def add_page(self, num):
+        self.pages.append(num)
+
+    # items are (title, destination, children) with title and destination serialized
+    def add_outline(self, items):
+        self.outline.extend(items)
+
+    def add_destinations(self, names, strings):
+        for name, destination in names.items():
+            self.dest_names.setdefault(name, destination)
+        for key, entry in strings.items():
+            self.dest_strings.setdefault(key, entry)
+
+    # items with children are written closed, their count is negative
+    def write_outline_items(self, items, parent_num):
+        nums = [self.allocate() for _ in items]
+        for i, (title, destination, children) in enumerate(items):
+            body = [b'<</Title %s/Parent %d 0 R' % (title, parent_num)]
+            if i > 0:
+                body.append(b'/Prev %d 0 R' % nums[i - 1])
+            if i + 1 < len(nums):
+                body.append(b'/Next %d 0 R' % nums[i + 1])
+            if children:
+                first, last = self.write_outline_items(children, nums[i])
+                body.append(b'/First %d 0 R/Last %d 0 R/Count -%d' % (first, last, len(children)))
+            body.append(b'/Dest ' + destination)
+            self.write_object(nums[i], b''.join(body) + b'>>')
+        return nums[0], nums[-1]
+
+    def close(self):
+        kids = b' '.join(b'%d 0 R' % num for num in self.pages)
+        self.write_object(self.pages_num, b'<</Type/Pages/Kids[%s]/Count %d>>' % (kids, len(self.pages)))
+        outline = b''
+        if self.outline:
+            outline_num = self.allocate()
+            first, last = self.write_outline_items(self.outline, outline_num)
+            self.write_object(outline_num, b'<</Type/Outlines/First %d 0 R/Last %d 0 R/Count %d>>'
+                              % (first, last, len(self.outline)))
+            outline = b'/Outlines %d 0 R' % outline_num
+        if self.dest_names:
+            dests_num = self.allocate()
+            self.write_object(dests_num, b'<<%s>>' % b''.join(name + b' ' + destination
+                                                             for name, destination in self.dest_names.items()))
+            outline += b'/Dests %d 0 R' % dests_num
+        if self.dest_strings:
+            # a single leaf, its names sorted as the name tree requires
+            names_num = self.allocate()
+            self.write_object(names_num, b'<</Names[%s]>>' % b' '.join(
+                key + b' ' + destination for _, (key, destination) in sorted(self.dest_strings.items())))
+            outline += b'/Names<</Dests %d 0 R>>' % names_num
+        catalog_num = self.allocate()
+        self.write_object(catalog_num, b'<</Type/Catalog/Pages %d 0 R%s>>' % (self.pages_num, outline))
+        trailer_info = b''
+        if self.info is not None:
+            info_num = self.allocate()
+            self.write_object(info_num, self.info)
+            trailer_info = b'/Info %d 0 R' % info_num
+        xref_offset = self.position
+        self.write(b'xref\n0 %d\n0000000000 65535 f \n' % len(self.offsets))
+        for offset in self.offsets[1:]:
+            if offset is None:
+                self.write(b'0000000000 65535 f \n')
+            else:
+                self.write(b'%010d 00000 n \n' % offset)
+        self.write(b'trailer\n<</Size %d/Root %d 0 R%s>>\nstartxref\n%d\n%%%%EOF\n'
+                   % (len(self.offsets), catalog_num, trailer_info, xref_offset))
+
+
+def pdf_number(value):
+    if float(value).is_integer():
+        return b'%d' % value
+    return ('%.4f' % value).rstrip('0').encode('ascii')
+
+
+class ObjectCopier:
+    """Copies the object graph of pages of one PyPDF2 reader into a StreamingPdfWriter.
+
+    Objects get new numbers on first reference and are written right after the object that
+    referenced them, nothing copied is kept in memory afterwards.
+
+    With a shared dict, streams, fonts and graphic states identical to ones copied before,
+    from this or another document, reuse the object already written. Identity is a digest
+    of the object with its references replaced by digests of their targets, so fonts with
+    the same program match even when their objects are numbered differently; objects in
+    reference cycles or reaching back to pages are never shared.
+    """
+
+    def __init__(self, writer, reader, shared=None):
+        self.writer = writer
+        self.reader = reader
+        self.shared = shared
+        self.numbers = {}
+        self.digests = {}
+        self.queue = []
+
+    # pages are numbered before copying, so links between pages point at the copied pages
+    def reserve_pages(self, pages):
+        numbers = []
+        for page in pages:
+            num = self.writer.allocate()
+            if page.indirectRef is not None:
+                key = (page.indirectRef.idnum, page.indirectRef.generation)
+                self.numbers[key] = num
+                self.digests[key] = None
+            numbers.append(num)
+        return numbers
+
+    def copy_page(self, page, num):
+        entries = [(key, value) for key, value in page.items() if key != '/Parent']
+        body = b'<</Parent %d 0 R' % self.writer.pages_num + self.serialize_entries(entries) + b'>>'
+        self.writer.write_object(num, body)
+        self.writer.add_page(num)
+        self.flush()
+
+    def copy_pages(self, pages):
+        for page, num in zip(pages, self.reserve_pages(pages)):
+            self.copy_page(page, num)
+
+    # outline of the reader as writer items; items pointing at pages that were not copied are
+    # left out and their children take their place
+    def outline_items(self, outlines):
+        items = []
+        for outline in outlines:
+            if isinstance(outline, list):
+                children = self.outline_items(outline)
+                if items and items[-1] is not None:
+                    items[-1][2].extend(children)
+                else:
+                    items.extend(children)
+                continue
+            page = outline.raw_get('/Page')
+            num = self.numbers.get((page.idnum, page.generation)) if isinstance(page, IndirectObject) else None
+            if num is None:
+                items.append(None)
+                continue
+            arguments = outline.getDestArray()[1:]
+            destination = b'[%d 0 R %s]' % (num, b' '.join(self.serialize(argument) for argument in arguments))
+            items.append((self.serialize(outline['/Title']), destination, []))
+        self.flush()
+        return [item for item in items if item is not None]
+
+    # serialized destination array with its page remapped, None when the page was not copied
+    def destination(self, value):
+        value = value.getObject()
+        if isinstance(value, DictionaryObject):
+            value = value.get('/D')
+            value = value.getObject() if value is not None else None
+        if not isinstance(value, ArrayObject) or not value or not isinstance(value[0], IndirectObject):
+            return None
+        num = self.numbers.get((value[0].idnum, value[0].generation))
+        if num is None:
+            return None
+        return b'[%d 0 R %s]' % (num, b' '.join(self.serialize(item) for item in value[1:]))
+
+    # named destinations of the reader pointing at copied pages, for StreamingPdfWriter.add_destinations:
+    # names of the catalog /Dests dictionary and strings of the /Names /Dests tree
+    def named_destinations(self):
+        catalog = self.reader.trailer['/Root']
+        names, strings = {}, {}
+        if '/Dests' in catalog:
+            for name, value in catalog['/Dests'].items():
+                destination = self.destination(value)
+                if destination is not None:
+                    names[self.serialize(name)] = destination
+        if '/Names' in catalog and '/Dests' in catalog['/Names']:
+            for key, value in name_tree_items(catalog['/Names']['/Dests']):
+                destination = self.destination(value)
+                if destination is not None:
+                    strings[getattr(key, 'original_bytes', key)] = (self.serialize(key), destination)
+        self.flush()
+        return names, strings
+
+    # document information dictionary of the reader, serialized; None when it has none
+    def info(self):
+        if '/Info' not in self.reader.trailer:
+            return None
+        info = self.reader.trailer['/Info'].getObject()
+        if not isinstance(info, DictionaryObject):
+            return None
+        body = self.serialize(info)
+        self.flush()
+        return body
+
+    def number_for(self, ref):
+        key = (ref.idnum, ref.generation)
+        if key in self.numbers:
+            return self.numbers[key]
+        obj = ref.getObject()
+        # page tree nodes and pages that are not copied themselves would drag the whole source tree along
+        if isinstance(obj, DictionaryObject) and obj.get('/Type') in ('/Pages', '/Page'):
+            self.numbers[key] = None
+            return None
+        digest = self.digest(ref) if self.shared is not None and is_shareable(obj) else None
+        if digest is not None and digest in self.shared:
+            self.numbers[key] = self.shared[digest]
+            return self.numbers[key]
+        num = self.writer.allocate()
+        self.numbers[key] = num
+        if digest is not None:
+            self.shared[digest] = num
+        self.queue.append((num, obj))
+        return num
+
+    # None for objects that must not be shared
+    def digest(self, obj, depth=0):
+        if isinstance(obj, IndirectObject):
+            key = (obj.idnum, obj.generation)
+            if key in self.digests:
+                return self.digests[key]
+            if depth > max_digest_depth:
+                return None
+            # stays None while the object is being hashed, so cycles come out unshareable
+            self.digests[key] = None
+            self.digests[key] = self.digest(obj.getObject(), depth + 1)
+            return self.digests[key]
+        if isinstance(obj, DictionaryObject):
+            if obj.get('/Type') in ('/Pages', '/Page'):
+                return None
+            parts = [b'S' if isinstance(obj, StreamObject) else b'D']
+            for key in sorted(obj):
+                if key == '/Length' and isinstance(obj, StreamObject):
+                    continue
+                value = self.digest(obj[key], depth + 1)
+                if value is None:
+                    return None
+                parts.append(key.encode('latin-1') + value)
+            if isinstance(obj, StreamObject):
+                parts.append(hashlib.sha256(obj._data).digest())
+            return hashlib.sha256(b'\0'.join(parts)).digest()
+        if isinstance(obj, ArrayObject):
+            parts = [b'A']
+            for item in obj:
+                value = self.digest(item, depth + 1)
+                if value is None:
+                    return None
+                parts.append(value)
+            return hashlib.sha256(b'\0'.join(parts)).digest()
+        buffer = BytesIO()
+        obj.writeToStream(buffer, None)
+        return hashlib.sha256(buffer.getvalue()).digest()
+
+    def flush(self):
+        while self.queue:
+            num, obj = self.queue.pop()
+            self.write(num, obj)
+
+    def write(self, num, obj):
+        if isinstance(obj, StreamObject):
+            self.writer.write_stream(num, *self.stream_content(obj))
+        else:
+            self.writer.write_object(num, self.serialize(obj))
+
+    # serialized dictionary entries and data of a stream, subclasses may replace the data
+    def stream_content(self, obj):
+        entries = [(key, value) for key, value in obj.items() if key != '/Length']
+        return self.serialize_entries(entries), obj._data
+
+    def serialize_entries(self, entries):
+        return b''.join(key.encode('latin-1') + b' ' + self.serialize(value) for key, value in entries)
+
+    def serialize(self, obj):
+        if isinstance(obj, IndirectObject):
+            num = self.number_for(obj)
+            return b'null' if num is None else b'%d 0 R' % num
+        if isinstance(obj, StreamObject):
+            raise ValueError('direct stream objects are not allowed')
+        if isinstance(obj, DictionaryObject):
+            return b'<<' + self.serialize_entries(obj.items()) + b'>>'
+        if isinstance(obj, ArrayObject):
+            return b'[' + b' '.join(self.serialize(item) for item in obj) + b']'
+        buffer = BytesIO()
+        obj.writeToStream(buffer, None)
+        return buffer.getvalue()
+
+
+def is_shareable(obj):
+    return isinstance(obj, StreamObject) or isinstance(obj, DictionaryObject) and obj.get('/Type') in shared_types
+
+
+# key and value pairs of a name tree, kids reached twice or too deep are skipped
+def name_tree_items(node, seen=None, depth=0):
+    seen = set() if seen is None else seen
+    node = node.getObject()
+    if id(node) in seen or depth > max_digest_depth:
+        return
+    seen.add(id(node))
+    names = node.get('/Names', ArrayObject()).getObject()
+    for i in range(0, len(names) - 1, 2):
+        yield names[i].getObject(), names[i + 1]
+    for kid in node.get('/Kids', ArrayObject()).getObject():
+        yield from name_tree_items(kid, seen, depth + 1)
+
+
+def read_outlines(pdf_reader):
+    try:
+        return pdf_reader.getOutlines()
+    except Exception as error:
+        logger.warning('Bookmarks could not be read and are left out: %s', error)
+        return []
+
+
+def read_destinations(copier):
+    try:
+        return copier.named_destinations()
+    except Exception as error:
+        logger.warning('Named destinations could not be read and are left out: %s', error)
+        return {}, {}
+
+
+def read_info(copier):
+    try:
+        return copier.info()
+    except Exception as error:
+        logger.warning('Document information could not be read and is left out: %s', error)
+        return None
+
+
+# inputs are copied one at a time straight into the output, so memory is bounded by the
+# biggest input rather than by all of them together; bookmarks and named destinations of the
+# inputs are kept, document information of the first one. Fonts and images repeated across the
+# inputs are written once
+def merge_documents(list_of_files, output_path):
+    with open(output_path, 'wb') as output:
+        writer = StreamingPdfWriter(output)
+        shared = {}
+        for file_path in list_of_files:
+            with open(file_path, 'rb') as input_file:
+                pdf_reader = PdfFileReader(input_file, strict=False)
+                if pdf_reader.isEncrypted:
+                    pdf_reader.decrypt('')
+                copier = ObjectCopier(writer, pdf_reader, shared)
+                copier.copy_pages([pdf_reader.getPage(i) for i in range(pdf_reader.getNumPages())])
+                writer.add_outline(copier.outline_items(read_outlines(pdf_reader)))
+                writer.add_destinations(*read_destinations(copier))
+                if file_path == list_of_files[0]:
+                    writer.info = read_info(copier)
+        writer.close()
+    return output_path
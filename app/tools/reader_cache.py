@@ -0,0 +1,82 @@
+# LRU cache of parsed pdf readers shared by count_pages, split and delete
+import contextlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+from PyPDF2 import PdfFileReader
+
+logger = logging.getLogger(__name__)
+
+
+class ReaderCache:
+    def __init__(self, max_entries=32):
+        self.max_entries = max_entries
+        self.readers = OrderedDict()
+        # readers jobs are working with -> number of jobs, an evicted one is closed by the last of them
+        self.users = {}
+        self.lock = threading.Lock()
+
+    # a file is identified by its path together with size and mtime, so rewritten files are parsed again
+    @staticmethod
+    def signature(file_path):
+        stat = os.stat(file_path)
+        return os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns
+
+    def get(self, file_path, use=False):
+        key = self.signature(file_path)
+        with self.lock:
+            if key in self.readers:
+                self.readers.move_to_end(key)
+                return self.taken(self.readers[key], use)
+        # parsing happens outside the lock, other documents are not blocked meanwhile
+        pdf_reader = PdfFileReader(open(file_path, 'rb'), strict=False)
+        pdf_reader.getNumPages()
+        with self.lock:
+            if key in self.readers:
+                pdf_reader.stream.close()
+                return self.taken(self.readers[key], use)
+            self.readers[key] = pdf_reader
+            while len(self.readers) > self.max_entries:
+                _, evicted = self.readers.popitem(last=False)
+                self.close(evicted)
+            return self.taken(pdf_reader, use)
+
+    # called with the lock held
+    def taken(self, pdf_reader, use):
+        if use:
+            self.users[pdf_reader] = self.users.get(pdf_reader, 0) + 1
+        return pdf_reader
+
+    # called with the lock held, readers still in use stay open
+    def close(self, pdf_reader):
+        if pdf_reader not in self.users:
+            pdf_reader.stream.close()
+
+    # reader of file_path that is not closed before the block ends, even when it is evicted meanwhile
+    @contextlib.contextmanager
+    def use(self, file_path):
+        pdf_reader = self.get(file_path, use=True)
+        try:
+            yield pdf_reader
+        finally:
+            with self.lock:
+                self.users[pdf_reader] -= 1
+                if not self.users[pdf_reader]:
+                    del self.users[pdf_reader]
+                    if not any(cached is pdf_reader for cached in self.readers.values()):
+                        pdf_reader.stream.close()
+
+    # drop readers of files inside folder, called when the job owning the folder is over
+    def evict(self, folder):
+        folder = os.path.join(os.path.abspath(folder), '')
+        with self.lock:
+            keys = [key for key in self.readers if key[0].startswith(folder)]
+            for key in keys:
+                self.close(self.readers.pop(key))
+        if keys:
+            logger.info('%d parsed document(s) evicted from cache', len(keys))
+
+
+reader_cache = ReaderCache()
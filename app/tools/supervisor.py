@@ -0,0 +1,268 @@
+# external tools run under supervision: wall-clock timeout, memory and cpu rlimits, their own
+# process group that is killed as a whole on timeout or when the user cancels, stderr kept for the log
+import contextlib
+import contextvars
+import logging
+import os
+import resource
+import signal
+import subprocess
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# seconds, megabytes and cpu seconds; 0 switches a limit off
+timeout = 600
+memory_limit = 4096
+cpu_limit = 600
+stderr_tail = 4096
+# processes of a tool running at once in this process, shared by every job and every batch;
+# tools not listed are not limited
+slots = {'gs': threading.BoundedSemaphore(os.cpu_count() or 1)}
+
+# who the work is done for, set by handlers and carried into executor threads with the context
+owner = contextvars.ContextVar('owner', default=None)
+# the job the work belongs to, see as_job()
+job = contextvars.ContextVar('job', default=None)
+guards = {}
+jobs = {}
+guards_lock = threading.Lock()
+
+
+class ToolError(Exception):
+    def __init__(self, message, returncode=None, stderr=''):
+        super().__init__(message)
+        self.returncode = returncode
+        self.stderr = stderr
+
+
+class ToolTimeout(ToolError):
+    pass
+
+
+class ToolCancelled(ToolError):
+    pass
+
+
+def configure(timeout_seconds, memory_megabytes, cpu_seconds, ghostscript_processes=0):
+    global timeout, memory_limit, cpu_limit
+    timeout, memory_limit, cpu_limit = timeout_seconds, memory_megabytes, cpu_seconds
+    if ghostscript_processes > 0:
+        slots['gs'] = threading.BoundedSemaphore(ghostscript_processes)
+    else:
+        slots.pop('gs', None)
+
+
+class NoSlot(ToolError):
+    pass
+
+
+# waits for a free slot of the tool, a cancelled job stops waiting; blocking False raises NoSlot
+# instead of waiting
+def take_slot(slot, blocking=True):
+    if not blocking:
+        if not slot.acquire(blocking=False):
+            raise NoSlot('no free slot')
+        return
+    while not slot.acquire(timeout=0.5):
+        check_cancelled()
+
+
+# set on the child right after it is spawned: code run between fork and exec may deadlock when
+# the parent has threads, and the tools are always started from thread pools
+def apply_limits(pid, cpu=True):
+    try:
+        if memory_limit > 0:
+            size = memory_limit * 1024 * 1024
+            resource.prlimit(pid, resource.RLIMIT_AS, (size, size))
+        if cpu and cpu_limit > 0:
+            resource.prlimit(pid, resource.RLIMIT_CPU, (cpu_limit, cpu_limit + 5))
+    except ProcessLookupError:
+        pass
+
+
+def kill_group(process):
+    if process.poll() is None:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+class Guard:
+    """Something that can be stopped from outside: by its timeout or by cancel() of its owner."""
+
+    def __init__(self, kill, seconds=None):
+        self.kill = kill
+        self.owner = owner.get()
+        self.reason = None
+        self.timer = None
+        seconds = timeout if seconds is None else seconds
+        if seconds > 0:
+            self.timer = threading.Timer(seconds, self.stop, ('timeout',))
+            self.timer.daemon = True
+
+    def stop(self, reason):
+        if self.reason is None:
+            self.reason = reason
+            self.kill()
+
+    # raises ToolCancelled when the job was cancelled already
+    def __enter__(self):
+        with guards_lock:
+            check_cancelled()
+            guards.setdefault(self.owner, set()).add(self)
+        if self.timer is not None:
+            self.timer.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.timer is not None:
+            self.timer.cancel()
+        with guards_lock:
+            owned = guards.get(self.owner, set())
+            owned.discard(self)
+            if not owned:
+                guards.pop(self.owner, None)
+
+
+class Process:
+    """A supervised child process; stderr goes to a temporary file so it can never fill a pipe."""
+
+    def __init__(self, command, capture_output=False, seconds=None, blocking=True):
+        self.command = command
+        self.name = os.path.basename(command[0])
+        check_cancelled()
+        # held until wait() is done, without blocking NoSlot is raised when every slot is taken
+        self.slot = slots.get(self.name)
+        if self.slot is not None:
+            take_slot(self.slot, blocking)
+        try:
+            self.stderr = tempfile.TemporaryFile()
+            self.process = subprocess.Popen(command, stdout=subprocess.PIPE if capture_output else subprocess.DEVNULL,
+                                            stderr=self.stderr, start_new_session=True)
+        except BaseException:
+            self.release()
+            raise
+        apply_limits(self.process.pid)
+        try:
+            self.guard = Guard(self.kill, seconds).__enter__()
+        except ToolCancelled:
+            # cancelled while it was being started
+            self.kill()
+            self.process.wait()
+            self.stderr.close()
+            self.release()
+            raise
+
+    def release(self):
+        if self.slot is not None:
+            self.slot.release()
+            self.slot = None
+
+    def kill(self):
+        kill_group(self.process)
+
+    def wait(self):
+        try:
+            stdout, _ = self.process.communicate()
+        finally:
+            self.guard.__exit__(None, None, None)
+            self.kill()
+            self.stderr.seek(max(0, self.stderr.seek(0, os.SEEK_END) - stderr_tail))
+            stderr = self.stderr.read().decode(errors='replace').strip()
+            self.stderr.close()
+            self.release()
+        returncode = self.process.returncode
+        if self.guard.reason == 'timeout':
+            logger.error('%s timed out: %s', self.name, stderr)
+            raise ToolTimeout('{} timed out'.format(self.name), returncode, stderr)
+        if self.guard.reason == 'cancel':
+            raise ToolCancelled('{} was cancelled'.format(self.name), returncode, stderr)
+        if returncode != 0:
+            logger.error('%s exited with code %s: %s', self.name, returncode, stderr)
+            raise ToolError('{} exited with code {}'.format(self.name, returncode), returncode, stderr)
+        if stderr:
+            logger.info('%s: %s', self.name, stderr)
+        return stdout
+
+    # stop without raising, for processes whose result is no longer needed
+    def discard(self):
+        self.guard.stop('discard')
+        with contextlib.suppress(ToolError):
+            self.wait()
+
+
+# pool.submit that keeps the owner of the calling thread, so cancel() reaches the work too
+def submit(pool, function, *args, **kwargs):
+    return pool.submit(contextvars.copy_context().run, function, *args, **kwargs)
+
+
+# thread pool for the files of one job; when the job fails or is cancelled, files that did not
+# start yet are dropped instead of being waited for
+@contextlib.contextmanager
+def batch_pool(workers):
+    pool = ThreadPoolExecutor(max_workers=workers)
+    try:
+        yield pool
+    except BaseException:
+        pool.shutdown(cancel_futures=True)
+        raise
+    finally:
+        pool.shutdown()
+
+
+class Job:
+    def __init__(self, job_owner):
+        self.owner = job_owner
+        self.cancelled = False
+
+
+def as_job(function, *args, **kwargs):
+    """Call function as one job of the current owner.
+
+    Once cancel() stopped the job, every tool it starts is cancelled right away, so files of a
+    batch waiting for their turn are not started anymore. A later job of the same owner is not affected.
+    """
+    current = Job(owner.get())
+    with guards_lock:
+        jobs.setdefault(current.owner, set()).add(current)
+    token = job.set(current)
+    try:
+        return function(*args, **kwargs)
+    finally:
+        job.reset(token)
+        with guards_lock:
+            owned = jobs.get(current.owner, set())
+            owned.discard(current)
+            if not owned:
+                jobs.pop(current.owner, None)
+
+
+# raises ToolCancelled when the job of the calling thread was cancelled
+def check_cancelled():
+    current = job.get()
+    if current is not None and current.cancelled:
+        raise ToolCancelled('job of {} was cancelled'.format(current.owner))
+
+
+def run(command, capture_output=False, seconds=None):
+    """Run command to the end and return its stdout when capture_output is set.
+
+    Raises ToolTimeout, ToolCancelled or ToolError for a non-zero exit code.
+    """
+    return Process(command, capture_output, seconds).wait()
+
+
+# stop everything running for owner, jobs of owner start no new tools afterwards
+def cancel(job_owner):
+    with guards_lock:
+        for current in jobs.get(job_owner, ()):
+            current.cancelled = True
+        owned = list(guards.get(job_owner, ()))
+    for guard in owned:
+        guard.stop('cancel')
+    if owned:
+        logger.info('Cancelled %d running tool(s) of %s', len(owned), job_owner)
@@ -1,11 +1,18 @@
+import itertools
+import logging
 import os
+import threading
 
-from PyPDF2 import PdfFileMerger, PdfFileWriter, PdfFileReader
-from PIL import Image
-from zipfile import ZipFile
-import re
+from PyPDF2 import PdfFileWriter
 
-from app.tools import libreoffice_converter, pdf_compressor
+from app.tools import (compression, image_converter, libreoffice_converter, libreoffice_pool, page_splitter,
+                       pdf_probe, supervisor)
+from app.tools.archive import StreamingZip
+from app.tools.page_range import PageSelection
+from app.tools.pdf_writer import merge_documents
+from app.tools.reader_cache import reader_cache
+
+logger = logging.getLogger(__name__)
 
 
 # invalid format checker
@@ -20,47 +27,62 @@ def check_invalid_format(file_name, function):
         return False, format_functions[function]
 
 
-# basic function to create range from string
-def create_range(x, num_of_pages):
-    result = []
-    for part in x.split(','):
-        if '-' in part or ':' in part:
-            a, b = re.split('[-:]', part)
-            if b == '': b = num_of_pages
-            a, b = int(a), int(b)
-            result.extend(range(a, b + 1))
-        else:
-            a = int(part)
-            result.append(a)
-    return result
+# count pages in pdf, the full parser is used only when the light probe fails
+def count_pages(file_path):
+    try:
+        return pdf_probe.count_pages(file_path)
+    except Exception as e:
+        logger.info('Page count probe failed for "%s": %s', os.path.basename(file_path), e)
+    with reader_cache.use(file_path) as pdf_reader:
+        return pdf_reader.getNumPages()
 
 
-# count pages in pdf
-def count_pages(file_path):
-    input_file = open(file_path, 'rb')
-    pdf_reader = PdfFileReader(input_file, strict=False)
-    return pdf_reader.getNumPages()
+# parse pdf ahead of time, so split or delete of the file does not wait for it
+def preload(file_path):
+    reader_cache.get(file_path)
+
+
+# documents of a multi-file batch compressed at once, their ghostscript processes still share
+# the slots of app.tools.supervisor with every other job
+batch_workers = os.cpu_count() or 1
 
 
-# compress document(s)
-def compress(list_of_files, output_folder):
+# compress document(s), engine 'images' re-encodes images only instead of a ghostscript re-render
+def compress(list_of_files, output_folder, engine='ghostscript'):
     if len(list_of_files) > 1:
         output_path = os.path.join(output_folder, 'documents_compressed.zip')
-        zipObj = ZipFile(output_path, 'w')
-        for file_path in list_of_files:
-            fname = os.path.join(os.path.basename(file_path).replace('.pdf', ''))
-            filename = os.path.join('{}_compressed.pdf'.format(fname))
-            pdf_compressor.compress(file_path, os.path.join(output_folder, filename))
-            zipObj.write(os.path.join(output_folder, filename), filename)
-            os.remove(os.path.join(output_folder, filename))
-        zipObj.close()
+        workers = min(batch_workers, len(list_of_files))
+        with StreamingZip(output_path) as archive, supervisor.batch_pool(workers) as pool:
+            # a small window of documents runs ahead of the archive, so a slow document holds back
+            # a few compressed ones in memory, not the rest of the batch
+            files = iter(list_of_files)
+            window = [(file_path, supervisor.submit(pool, compression.compress_to_bytes, file_path, engine))
+                      for file_path in itertools.islice(files, workers * 2)]
+            # compressed documents go to the archive in input order as soon as each one is ready,
+            # documents that could not be made smaller go there as they are
+            while window:
+                file_path, job = window.pop(0)
+                document = job.result()
+                next_path = next(files, None)
+                if next_path is not None:
+                    window.append((next_path, supervisor.submit(pool, compression.compress_to_bytes, next_path,
+                                                                engine)))
+                fname = os.path.join(os.path.basename(file_path).replace('.pdf', ''))
+                filename = os.path.join('{}_compressed.pdf'.format(fname))
+                if document is not None and len(document) < os.path.getsize(file_path):
+                    archive.write_bytes(filename, document)
+                else:
+                    with open(file_path, 'rb') as original:
+                        archive.write_stream(filename, original)
 
     elif len(list_of_files) == 1:
         file_path = list_of_files[0]
         fname = os.path.join(os.path.basename(file_path).replace('.pdf', ''))
         output_path = os.path.join(output_folder, '{}_compressed.pdf'.format(fname))
         try:
-            pdf_compressor.compress(file_path, output_path)
+            compression.compress_document(file_path, output_path, engine=engine)
+        except supervisor.ToolCancelled:
+            raise
         except:
             return None
 
@@ -69,86 +91,80 @@ def compress(list_of_files, output_folder):
 
 # merge multiple documents into one
 def merge(list_of_files, output_folder):
-    merger = PdfFileMerger()
-    for file_path in list_of_files:
-        input_file = open(file_path, 'rb')
-        pdf_reader = PdfFileReader(input_file, strict=False)
-        merger.append(pdf_reader)
     output_path = os.path.join(output_folder, 'document_merged.pdf')
-    with open(output_path, 'wb') as outputStream:
-        merger.write(outputStream)
-    return output_path
+    return merge_documents(list_of_files, output_path)
 
 
 # split pdf document into one or into separate files page by page
 def split(file_path, split_range_string, split_range, output_folder, separate_pages=False):
-    input_file = open(file_path, 'rb')
-    pdf_reader = PdfFileReader(input_file, strict=False)
-    fname = os.path.join(os.path.basename(file_path).replace('.pdf', ''))
-    if separate_pages:
-        output_path = os.path.join(output_folder, '{}-pages_{}.zip'.format(fname, split_range_string))
-        zipObj = ZipFile(output_path, 'w')
-        for i in split_range:
+    with reader_cache.use(file_path) as pdf_reader:
+        fname = os.path.join(os.path.basename(file_path).replace('.pdf', ''))
+        if separate_pages:
+            output_path = os.path.join(output_folder, '{}-pages_{}.zip'.format(fname, split_range_string))
+            with StreamingZip(output_path) as archive:
+                for i, document in page_splitter.split_pages(pdf_reader, file_path, PageSelection(split_range)):
+                    filename = os.path.join('{}-page_{}.pdf'.format(fname, i))
+                    archive.write_bytes(filename, document)
+            return output_path
+        else:
+            output_path = os.path.join(output_folder, '{}-pages_{}.pdf'.format(fname, split_range_string))
             splitter = PdfFileWriter()
-            splitter.addPage(pdf_reader.getPage(i - 1))
-            filename = os.path.join('{}-page_{}.pdf'.format(fname, i))
-            with open(os.path.join(output_folder, filename), 'wb') as outputStream:
+            for i in PageSelection(split_range):
+                splitter.addPage(pdf_reader.getPage(i - 1))
+            with open(output_path, 'wb') as outputStream:
                 splitter.write(outputStream)
-            zipObj.write(os.path.join(output_folder, filename), filename)
-            os.remove(os.path.join(output_folder, filename))
-        zipObj.close()
-        input_file.close()
-        return output_path
-    else:
-        output_path = os.path.join(output_folder, '{}-pages_{}.pdf'.format(fname, split_range_string))
-        splitter = PdfFileWriter()
-        for i in split_range:
-            splitter.addPage(pdf_reader.getPage(i - 1))
-        with open(output_path, 'wb') as outputStream:
-            splitter.write(outputStream)
-        input_file.close()
-        return output_path
+            return output_path
 
 
 # convert image(s) to pdf
 def img2pdf(list_of_files, output_folder):
     output_path = os.path.join(output_folder, 'document_fromImages.pdf')
-    list_of_images = []
-    for file_path in list_of_files:
-        image = Image.open(file_path).convert('RGB')
-        list_of_images.append(image)
-    list_of_images[0].save(output_path, save_all=True, resolution=100.0, append_images=list_of_images[1:])
-    return output_path
+    return image_converter.images_to_pdf(list_of_files, output_path)
 
 
 # delete pages from pdf
 def delete(file_path, delete_range_string, delete_range, output_folder):
-    input_file = open(file_path, 'rb')
-    pdf_reader = PdfFileReader(input_file, strict=False)
-    pages_to_keep = [p for p in range(pdf_reader.getNumPages()) if p + 1 not in delete_range]
-    keeper = PdfFileWriter()
-    fname = os.path.join(os.path.basename(file_path).replace('.pdf', ''))
-    output_path = os.path.join(output_folder, '{}-without_{}.pdf'.format(fname, delete_range_string))
-    for i in pages_to_keep:
-        keeper.addPage(pdf_reader.getPage(i))
-    with open(output_path, 'wb') as outputStream:
-        keeper.write(outputStream)
-    input_file.close()
-    return output_path
+    with reader_cache.use(file_path) as pdf_reader:
+        pages_to_keep = PageSelection(delete_range).complement(pdf_reader.getNumPages())
+        keeper = PdfFileWriter()
+        fname = os.path.join(os.path.basename(file_path).replace('.pdf', ''))
+        output_path = os.path.join(output_folder, '{}-without_{}.pdf'.format(fname, delete_range_string))
+        for i in pages_to_keep:
+            keeper.addPage(pdf_reader.getPage(i - 1))
+        with open(output_path, 'wb') as outputStream:
+            keeper.write(outputStream)
+        return output_path
 
 
-# convert doc(x) to pdf
-def doc2pdf(list_of_files, output_folder):
+# cold started libreoffice processes of this process share one user profile and cannot run side by side
+cold_office_lock = threading.Lock()
+
+
+# convert one office document, warm pooled instances are used when available
+def office2pdf(conversion_type, file_path, output_folder):
+    if libreoffice_pool.pool is not None:
+        libreoffice_pool.pool.convert(conversion_type, file_path, output_folder)
+    else:
+        with cold_office_lock:
+            libreoffice_converter.convert(conversion_type, file_path, output_folder, libreoffice_pool.cold_profile())
+
+
+# convert office documents to pdf, batches are spread over the pooled instances
+def convert_office_files(conversion_type, list_of_files, output_folder):
     if len(list_of_files) > 1:
         output_path = os.path.join(output_folder, 'documents_one-by-one.zip')
-        zipObj = ZipFile(output_path, 'w')
-        for file_path in list_of_files:
-            fname = os.path.join(os.path.basename(file_path))
-            filename = '{}.pdf'.format(''.join(fname.split('.')[:-1]))
-            libreoffice_converter.convert('doc2pdf', file_path, output_folder)
-            zipObj.write(os.path.join(output_folder, filename), filename)
-            os.remove(os.path.join(output_folder, filename))
-        zipObj.close()
+        office_workers = libreoffice_pool.pool.size if libreoffice_pool.pool is not None else 1
+        with StreamingZip(output_path) as archive, \
+                supervisor.batch_pool(min(office_workers, len(list_of_files))) as pool:
+            jobs = []
+            for file_path in list_of_files:
+                fname = os.path.join(os.path.basename(file_path))
+                filename = '{}.pdf'.format(''.join(fname.split('.')[:-1]))
+                jobs.append((filename, supervisor.submit(pool, office2pdf, conversion_type, file_path, output_folder)))
+            # libreoffice can only write to files, they are moved into the archive one by one
+            for filename, job in jobs:
+                job.result()
+                archive.write_file(filename, os.path.join(output_folder, filename))
 
     elif len(list_of_files) == 1:
         file_path = list_of_files[0]
@@ -156,32 +172,19 @@ def doc2pdf(list_of_files, output_folder):
         filename = '{}.pdf'.format(''.join(fname.split('.')[:-1]))
         output_path = os.path.join(output_folder, filename)
         try:
-            libreoffice_converter.convert('doc2pdf', file_path, output_folder)
+            office2pdf(conversion_type, file_path, output_folder)
+        except supervisor.ToolCancelled:
+            raise
         except:
             return None
     return output_path
 
 
+# convert doc(x) to pdf
+def doc2pdf(list_of_files, output_folder):
+    return convert_office_files('doc2pdf', list_of_files, output_folder)
+
+
 # convert ppt(x) to pdf
 def ppt2pdf(list_of_files, output_folder):
-    if len(list_of_files) > 1:
-        output_path = os.path.join(output_folder, 'documents_one-by-one.zip')
-        zipObj = ZipFile(output_path, 'w')
-        for file_path in list_of_files:
-            fname = os.path.join(os.path.basename(file_path))
-            filename = '{}.pdf'.format(''.join(fname.split('.')[:-1]))
-            libreoffice_converter.convert('ppt2pdf', file_path, output_folder)
-            zipObj.write(os.path.join(output_folder, filename), filename)
-            os.remove(os.path.join(output_folder, filename))
-        zipObj.close()
-
-    elif len(list_of_files) == 1:
-        file_path = list_of_files[0]
-        fname = os.path.join(os.path.basename(file_path))
-        filename = '{}.pdf'.format(''.join(fname.split('.')[:-1]))
-        output_path = os.path.join(output_folder, filename)
-        try:
-            libreoffice_converter.convert('ppt2pdf', file_path, output_folder)
-        except:
-            return None
-    return output_path
+    return convert_office_files('ppt2pdf', list_of_files, output_folder)
@@ -4,7 +4,6 @@ import os
 import sys
 
 from aiogram import Bot, Dispatcher
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from datetime import datetime
 
 from app.config_reader import load_config
@@ -15,13 +14,17 @@ from app.handlers.convert import register_handlers_convert
 from app.handlers.delete import register_handlers_delete
 from app.handlers.merge import register_handlers_merge
 from app.handlers.split import register_handlers_split
+from app.modules import (cost_estimator, executor, file_cache, job_journal, job_queue, recovery, result_cache,
+                         scheduler, worker, workspace)
+from app.modules.fsm_storage import SqliteStorage
+from app.tools import compression, image_converter, libreoffice_pool, page_splitter, supervisor
+from app.tools.reader_cache import reader_cache
 
 
-async def main():
-    # setting up logging
+def setup_logging(name):
     os.chdir(os.path.dirname(os.path.realpath(__file__)))
     os.makedirs('logs', exist_ok=True)
-    logfile = 'logs/{}.log'.format(datetime.now().strftime("%Y-%m-%dT%H"))
+    logfile = 'logs/{}{}.log'.format(datetime.now().strftime("%Y-%m-%dT%H"), name)
     logging.basicConfig(
         # stream=sys.stdout,
         filename=logfile,
@@ -29,14 +32,54 @@ async def main():
         format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
     )
 
+
+# processing is off for a bot that leaves the tools to workers
+def configure_tools(config, processing=True):
+    supervisor.configure(config.limits.timeout, config.limits.memory, config.limits.cpu, config.limits.ghostscript)
+    executor.configure(config.executor)
+    reader_cache.max_entries = config.cache.readers_max_entries
+    if not processing:
+        return
+    libreoffice_pool.configure(config.libreoffice.pool_size, config.libreoffice.max_jobs,
+                               config.libreoffice.base_port)
+    image_converter.configure(config.images.workers, config.images.target_dpi, config.images.max_page_size)
+    page_splitter.configure(config.split.workers)
+    compression.configure(config.compression.shard_workers, config.compression.shard_min_size * 1024 * 1024,
+                          config.compression.shard_min_pages, config.compression.adaptive)
+
+
+def close_tools(config):
+    executor.shutdown(wait=False)
+    libreoffice_pool.close()
+    image_converter.configure(0, config.images.target_dpi, config.images.max_page_size)
+    page_splitter.configure(0)
+
+
+async def main():
+    # setting up logging
+    setup_logging('')
     logger = logging.getLogger(__name__)
     logger.info("Starting bot")
 
     # parsing config
     config = load_config(os.path.join('config', 'bot.ini'))
+    configure_tools(config, processing=not config.workers.remote)
+    if config.workers.remote:
+        job_queue.configure(config.workers.queue_path)
+        # the journal resumes what the previous run left, workers may drop it
+        job_queue.queue.abandon()
+    file_cache.configure(config.cache.files_dir, config.cache.files_max_size * 1024 * 1024)
+    result_cache.configure(config.cache.results_path, config.cache.results_ttl * 3600,
+                           config.cache.results_max_entries)
+    workspace.configure(config.workspace.root, config.workspace.ram_root,
+                        config.workspace.ram_max_size * 1024 * 1024, config.workspace.ram_job_size * 1024 * 1024)
+    scheduler.configure(config.scheduler.slots, config.scheduler.per_user, config.scheduler.max_queued)
+    cost_estimator.configure(config.cost.path, config.cost.max_seconds)
+    job_journal.configure(config.journal.path)
     # ininitalizing bot
     bot = Bot(token=config.tg_bot.token)
-    dp = Dispatcher(bot, storage=MemoryStorage())
+    storage = SqliteStorage(config.storage.path, config.storage.flush_interval)
+    dp = Dispatcher(bot, storage=storage)
 
     # registering handlers
     register_handlers_common(dp)
@@ -47,9 +90,39 @@ async def main():
     register_handlers_delete(dp)
     register_handlers_convert(dp)
 
+    # jobs the previous run left unfinished go on next to the new ones
+    # workspaces of users still sending files are kept as well
+    plans = await recovery.plan(storage.values('workspace'))
+    recovery_task = asyncio.create_task(recovery.recover(bot, plans))
+
     # start polling
-    await dp.start_polling()
+    try:
+        await dp.start_polling()
+    finally:
+        recovery_task.cancel()
+        await storage.close()
+        await result_cache.result_cache.close()
+        await cost_estimator.cost_estimator.close()
+        close_tools(config)
+
+
+# worker process taking jobs from the job queue of a bot running with remote workers
+def run_worker():
+    setup_logging('-worker')
+    logger = logging.getLogger(__name__)
+    logger.info("Starting worker")
+
+    config = load_config(os.path.join('config', 'bot.ini'))
+    configure_tools(config)
+    job_queue.configure(config.workers.queue_path)
+    try:
+        worker.run(job_queue.queue)
+    finally:
+        close_tools(config)
 
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    if '--worker' in sys.argv[1:]:
+        run_worker()
+    else:
+        asyncio.run(main())